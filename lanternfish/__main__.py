@@ -7,19 +7,25 @@ logging.basicConfig(level=logging.WARNING) # For debugging purposes
 
 import llm_api
 import google_scholar
-import download_papers
 import pdf_to_markdown
 from generate_report import generate_report
+from pipeline import run_pipeline
+from checkpoint import RunCheckpoint, checkpoint_path
+from paper import Paper
+from evaluate_papers import evaluate_paper, prefilter_papers, ANALYSIS_MODES, LONG_PAPER_MODES
+from batch import read_prompts, run_batch
 import argparse
+import functools
 import logging
 import os
-import asyncio
-import math
 
 def command_line_arguments(args=None):
     parser = argparse.ArgumentParser(description="Lanternfish is a LLM research assistant that helps search through large amounts of research papers.")
-    parser.add_argument('-p', '--prompt', type=str, required=True, 
-        help="<Required> Description of what you want to find the research litterature. For example: 'Find resent papers using LLM's to help with cancer screening'.")
+    prompt_group = parser.add_mutually_exclusive_group(required=True)
+    prompt_group.add_argument('-p', '--prompt', type=str,
+        help="<Required unless --prompts_file is given> Description of what you want to find the research litterature. For example: 'Find resent papers using LLM's to help with cancer screening'.")
+    prompt_group.add_argument('--prompts_file', type=str, default=None,
+        help="Run a batch of prompts instead of a single --prompt: a text file with one prompt per line. Papers found by several prompts are downloaded, converted and quality reviewed only once, and one report is generated per prompt.")
     parser.add_argument('-m', '--model', default='gemma3:4b', type=str,
         help="The Ollama model to use for the LLM. Default is 'gemma3:4b'. See https://ollama.com/models for more models. Quantized models are also available.")
     parser.add_argument('-k', '--top_k', default=5, type=int,
@@ -28,14 +34,62 @@ def command_line_arguments(args=None):
         help="The minimal relevance score of the papers. Default is 0.6.")    
     parser.add_argument('-l', '--max_paper_length', default=50000, type=int, 
         help="The maximum number of characters of a paper that should be concerned.")
+    parser.add_argument('-a', '--min_abstract_relevance', default=2.0, type=float,
+        help="The minimal relevance score of the title and abstract of a paper for it to be downloaded. Set to 0 to download all papers. Default is 2.0.")
+    parser.add_argument('-t', '--max_paper_tokens', default=None, type=int,
+        help="If given, the most important sections of a paper (title, abstract, introduction, conclusion, then methods and results) are packed into this many tokens for the LLM instead of truncating the paper at --max_paper_length characters. The whole paper is then converted.")
+    parser.add_argument('--long_paper_mode', default='truncate', choices=LONG_PAPER_MODES,
+        help="How papers longer than --max_paper_length are handled. 'truncate' only sends the beginning of the paper to the LLM, 'map_reduce' splits the whole paper into chunks of --max_paper_length characters, reviews and summarizes the chunks concurrently and combines the results. Default is 'truncate'.")
     parser.add_argument('-q', '--min_quality', default=0.6, type=float, 
         help="The minimal quality score of the papers. Default is 0.6.")
     parser.add_argument('--max_papers_evaluated', default=50, type=int,
         help="The maximal number of returned from google scholar search for further evaluation. Default is 50.")
+    parser.add_argument('--score_method', default='logprobs', choices=['logprobs', 'sampling'],
+        help="How relevance and quality scores are computed. 'logprobs' makes a single LLM call and computes the expected score from the probabilities of the score tokens (falling back to 'sampling' if the LLM server does not return them). 'sampling' averages the scores of --n_samples_score LLM calls. Default is 'logprobs'.")
+    parser.add_argument('--analysis_mode', default='shared_prefix', choices=ANALYSIS_MODES,
+        help="How each paper is reviewed, scored and summarized. 'separate' uses a separate prompt layout for each step, 'shared_prefix' puts the paper first in every prompt so the LLM server can reuse its cache of the paper, and 'fused' returns the reviews, scores and summary in a single LLM call. Default is 'shared_prefix'.")
     parser.add_argument('--n_samples_score', default=1, type=int,
-        help="Number of times to sample from the LLM when computing relevance and quality scores. The final score is averaged. Default is 1.")
-
-    return parser.parse_args(args)
+        help="Number of times to sample from the LLM when computing relevance and quality scores with --score_method sampling. The final score is averaged. Default is 1.")
+    parser.add_argument('--max_concurrency', default=4, type=int,
+        help="The maximal number of papers reviewed, scored and summarized by the LLM at the same time. Default is 4.")
+    parser.add_argument('--max_downloads', default=8, type=int,
+        help="The maximal number of papers downloaded at the same time. Requests to the same host are further limited. Default is 8.")
+    parser.add_argument('--max_pdf_size', default=50, type=float,
+        help="The maximal size of a downloaded PDF in megabytes. Larger downloads are aborted. Default is 50.")
+    parser.add_argument('--conversion_mode', default='hybrid', choices=pdf_to_markdown.CONVERSION_MODES,
+        help="How PDFs are converted to markdown. 'fast' only uses the text embedded in the PDF, 'hybrid' uses the embedded text and pix2text for scanned pages and equations, and 'full' uses pix2text for every page. Default is 'hybrid'.")
+    parser.add_argument('--resume', default=None, type=str, metavar='RUN_ID',
+        help="Resume an interrupted run, skipping the search and the papers already downloaded and evaluated. The run id is printed at the start of each run.")
+    parser.add_argument('--no_llm_cache', action='store_true',
+        help="Do not read or write the persistent cache of LLM responses (stored in lanternfish/cache).")
+
+    parsed_args = parser.parse_args(args)
+    if parsed_args.long_paper_mode == "map_reduce":
+        if parsed_args.max_paper_tokens is not None:
+            parser.error("--long_paper_mode map_reduce cannot be combined with --max_paper_tokens.")
+        if parsed_args.analysis_mode == "fused":
+            parser.error("--long_paper_mode map_reduce cannot be combined with --analysis_mode fused.")
+    if parsed_args.prompts_file is not None and parsed_args.resume is not None:
+        parser.error("--resume cannot be combined with --prompts_file.")
+    if parsed_args.resume is not None and not os.path.exists(checkpoint_path(parsed_args.resume)):
+        parser.error(f"No checkpoint found for run {parsed_args.resume} at {checkpoint_path(parsed_args.resume)}.")
+
+    return parsed_args
+
+def evaluate_options(args):
+    """Return the keyword arguments of `evaluate_papers.evaluate_paper` given on the command line."""
+    return dict(max_paper_length=args.max_paper_length, min_relevance=args.min_relevance,
+                min_quality=args.min_quality, n_samples_score=args.n_samples_score,
+                score_method=args.score_method, analysis_mode=args.analysis_mode,
+                max_paper_tokens=args.max_paper_tokens, long_paper_mode=args.long_paper_mode)
+
+def conversion_max_chars(args):
+    """Return the character budget of each paper for the conversion."""
+    # With a token budget the sections are picked from the whole paper, and with map-reduce
+    # the whole paper is processed, so then the papers are converted completely
+    if args.max_paper_tokens is None and args.long_paper_mode == "truncate":
+        return args.max_paper_length
+    return None
 
 def main(args=None):
     """Main function to run the Lanternfish command line tool."""
@@ -43,51 +97,51 @@ def main(args=None):
     # Parse command line arguments
     args = command_line_arguments(args)
 
-    print("This may take quite some time, please be patient...")
+    if args.no_llm_cache:
+        llm_api.disable_cache()
 
-    # Generate search terms and search Google Scholar for papers
-    papers = google_scholar.search(args.prompt, args.max_papers_evaluated) 
+    if args.prompts_file is not None:
+        prompts = read_prompts(args.prompts_file)
+        print(f"Running a batch of {len(prompts)} prompts. This may take quite some time, please be patient...")
+        run_batch(prompts, args, evaluate_options(args), conversion_max_chars(args))
+        if llm_api.llm_client.cache is not None:
+            print(llm_api.llm_client.cache.stats())
+        return
 
-    # Download the papers
-    papers = download_papers.download_papers(papers)
-    
-    # Convert PDFs to markdown with LaTeX for equations
-    papers = pdf_to_markdown.convert_all(papers)
-    
-    print("Reviewing, scoring and summarizing the papers...") 
-    for paper in papers:
-        with open(paper["markdown path"], "r", encoding="utf-8") as f:
-            markdown_text = f.read()
-        
-        # Truncate the paper text at max_paper_length
-        markdown_text = markdown_text[:args.max_paper_length]
-        paper["markdown_text"] = markdown_text
-
-        # Review the relevancy of the paper the with respect to the prompt
-        paper["review relevancy"] = llm_api.generate_review_relevancy(args.prompt, markdown_text)
-
-        # Get relevance score of the full paper
-        paper["relevance score"] = asyncio.run(llm_api.generate_score(args.prompt, paper["review relevancy"], n_samples = args.n_samples_score, type = "relevance"))
-        if paper["relevance score"] < args.min_relevance:
-            continue
-
-        # Review the quality of the paper (normal review)
-        paper["review quality"] = llm_api.generate_review_quality(markdown_text)
-
-        # Get quality score
-        paper["quality score"] = asyncio.run(llm_api.generate_score(args.prompt, paper["review quality"], n_samples = args.n_samples_score, type = "quality"))
-        if paper["quality score"] < args.min_quality:
-            continue
-
-        # Calc total score
-        paper["total score"] = round(math.sqrt(paper["relevance score"] * paper["quality score"]), 1)
-
-        # Produce summaries of the papers with respect to the prompt
-        summary = llm_api.generate_summary(args.prompt, markdown_text)
-        paper["summary"] = summary
+    # Save the results of each stage as they are computed, so an interrupted run can be resumed
+    checkpoint = RunCheckpoint(args.resume)
+    print(f"Run id: {checkpoint.run_id} (resume an interrupted run with --resume {checkpoint.run_id})")
+
+    print("This may take quite some time, please be patient...")
+
+    saved_papers = checkpoint.get("papers")
+    if saved_papers is not None:
+        if saved_papers["prompt"] != args.prompt:
+            logging.warning(f"Resuming run {checkpoint.run_id} that was started with a different prompt: {saved_papers['prompt']}")
+        papers = [Paper.from_dict(paper) for paper in saved_papers["papers"]]
+    else:
+        # Generate search terms and search Google Scholar for papers
+        papers = google_scholar.search(args.prompt, args.max_papers_evaluated) 
+
+        # Drop papers with a clearly irrelevant abstract before downloading them
+        if args.min_abstract_relevance > 0:
+            papers = llm_api.run(prefilter_papers(papers, args.prompt, args.min_abstract_relevance,
+                                                  args.n_samples_score, args.max_concurrency, args.score_method))
+
+        checkpoint.save("papers", None, {"prompt": args.prompt, "papers": [paper.to_dict() for paper in papers]})
+
+    # Download the papers, convert the PDFs to markdown with LaTeX for equations and
+    # review, score and summarize them, with each paper flowing through the stages on its own
+    evaluate = functools.partial(evaluate_paper, prompt=args.prompt, **evaluate_options(args))
+    papers = llm_api.run(run_pipeline(papers, evaluate, args.max_concurrency, args.max_downloads,
+                                      conversion_mode=args.conversion_mode, max_chars=conversion_max_chars(args),
+                                      max_pdf_size_mb=args.max_pdf_size, checkpoint=checkpoint))
 
     # Generate a final report 
     generate_report(args.prompt, papers, args.top_k)
+
+    if llm_api.llm_client.cache is not None:
+        print(llm_api.llm_client.cache.stats())
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,200 @@
+from dedup import normalize_title
+import threading
+import itertools
+import sqlite3
+import logging
+import time
+import os
+import arxiv
+from thefuzz import fuzz
+from concurrent.futures import Future
+
+def strict_similarity(title, arxiv_title):
+    """Similarity (0-100) of two whole titles."""
+    return fuzz.ratio(normalize_title(title), normalize_title(arxiv_title))
+
+def loose_similarity(title, arxiv_title):
+    """
+    Similarity (0-100) of two titles that is 100 if the words of one title are contained
+    in the other, e.g. if a subtitle was added. Only used to compare a title with the
+    result of searching it, since any title containing it would match as well.
+    """
+    return fuzz.token_set_ratio(title.lower(), arxiv_title.lower())
+
+class ArxivLookup:
+    """
+    Resolve paper titles to arXiv papers through one shared, rate-limited arXiv client.
+
+    Lookups from concurrent threads are collected for up to `batch_wait` seconds
+    (or until `batch_size` titles are waiting) and resolved by a single arXiv query
+    matching any of their titles. Titles the batched query does not find are then
+    searched one at a time by relevance, as a title may differ slightly between the
+    paper and its arXiv version. All requests go through one `arxiv.Client`, which
+    waits `delay_seconds` between requests as asked by the arXiv API terms of use.
+
+    Resolutions are cached on disk by normalized title. Titles that are not on arXiv
+    are recorded in a `NegativeCache` and searched again with exponential backoff,
+    since papers keep being added to arXiv.
+    """
+
+    def __init__(self, cache_path="lanternfish/cache/arxiv_lookup.sqlite", batch_size=10, batch_wait=0.5,
+                 delay_seconds=3.0, similarity_threshold=80, negative_cache=None):
+        """
+        Args:
+            cache_path (str): Path to the SQLite database with the cached resolutions.
+            batch_size (int): Maximal number of titles resolved by one arXiv query.
+            batch_wait (float): Maximal number of seconds a lookup waits for others to batch with.
+            delay_seconds (float): Minimal number of seconds between two requests to the arXiv API.
+            similarity_threshold (int): Minimal similarity (0-100) between a title and the title on arXiv.
+            negative_cache (NegativeCache or None): Where titles not found on arXiv are recorded.
+                If None, they are searched again on every lookup.
+        """
+        folder = os.path.dirname(cache_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.similarity_threshold = similarity_threshold
+        self.negative_cache = negative_cache
+        self.client = arxiv.Client(delay_seconds=delay_seconds, num_retries=3)
+
+        self._pending = {}
+        self._has_leader = False
+        self._lock = threading.Lock()
+        self._batch_full = threading.Condition(self._lock)
+
+        self._db_lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS titles ("
+            "title TEXT PRIMARY KEY, arxiv_id TEXT, arxiv_title TEXT, pdf_url TEXT, created REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def _get_cached(self, key):
+        # Returns (found, result), where result is None for a recent miss
+        with self._db_lock:
+            row = self.connection.execute(
+                "SELECT arxiv_id, arxiv_title, pdf_url FROM titles WHERE title = ? AND arxiv_id IS NOT NULL", (key,)
+            ).fetchone()
+        if row is not None:
+            return True, {"arxiv_id": row[0], "title": row[1], "pdf_url": row[2]}
+        if self.negative_cache is not None and self.negative_cache.skip_reason(f"arxiv:{key}") is not None:
+            return True, None
+        return False, None
+
+    def _set_cached(self, key, result):
+        if result is None:
+            if self.negative_cache is not None:
+                self.negative_cache.record_failure(f"arxiv:{key}", "not found on arXiv")
+            return
+        with self._db_lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO titles (title, arxiv_id, arxiv_title, pdf_url, created) VALUES (?, ?, ?, ?, ?)",
+                (key, result["arxiv_id"], result["title"], result["pdf_url"], time.time()),
+            )
+            self.connection.commit()
+        if self.negative_cache is not None:
+            self.negative_cache.record_success(f"arxiv:{key}")
+
+    def lookup(self, title):
+        """
+        Find the arXiv version of the paper titled `title`. Safe to call from many threads.
+
+        Returns:
+            dict or None: The 'arxiv_id', 'title' and 'pdf_url' of the paper on arXiv,
+                          or None if no paper with a similar enough title was found.
+        """
+        key = normalize_title(title)
+        found, result = self._get_cached(key)
+        if found:
+            return result
+
+        with self._lock:
+            if key in self._pending:
+                future = self._pending[key][1]
+            else:
+                future = Future()
+                self._pending[key] = (title, future)
+                if len(self._pending) >= self.batch_size:
+                    self._batch_full.notify()
+            lead = not self._has_leader
+            if lead:
+                self._has_leader = True
+
+        if lead:
+            # This thread resolves batches until no lookups are waiting anymore
+            self._resolve_pending()
+        return future.result()
+
+    def _resolve_pending(self):
+        batch = {}
+        try:
+            while True:
+                with self._lock:
+                    self._batch_full.wait_for(lambda: len(self._pending) >= self.batch_size, timeout=self.batch_wait)
+                    batch = dict(itertools.islice(self._pending.items(), self.batch_size))
+                    for key in batch:
+                        del self._pending[key]
+                    if not batch:
+                        self._has_leader = False
+                        return
+                try:
+                    results = self._resolve({key: title for key, (title, _) in batch.items()})
+                except Exception as e:
+                    logging.info(f"arXiv lookup failed: {e}")
+                    results = {}
+                for key, (_, future) in batch.items():
+                    try:
+                        # Titles missing from the results could not be searched, so they are not cached
+                        if key in results:
+                            self._set_cached(key, results[key])
+                    except Exception as e:
+                        logging.info(f"Could not cache the arXiv lookup of {key}: {e}")
+                    finally:
+                        future.set_result(results.get(key))
+                batch = {}
+        finally:
+            # If the leader stopped unexpectedly, no lookup may be left waiting for it
+            with self._lock:
+                if self._has_leader:
+                    self._has_leader = False
+                    batch.update(self._pending)
+                    self._pending.clear()
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def _best_match(self, title, arxiv_results, similarity_function):
+        best, best_similarity = None, self.similarity_threshold - 1
+        for result in arxiv_results:
+            similarity = similarity_function(title, result.title)
+            if similarity > best_similarity:
+                best, best_similarity = result, similarity
+        return best
+
+    def _resolve(self, titles):
+        # Resolve a batch of titles (normalized title -> title). Returns normalized title -> result,
+        # where the result is None for titles not on arXiv and missing for titles that failed
+        query = " OR ".join(f'ti:"{key}"' for key in titles if key)
+        arxiv_results = list(self.client.results(arxiv.Search(query=query, max_results=3 * len(titles)))) if query else []
+        logging.info(f"arXiv query for {len(titles)} titles returned {len(arxiv_results)} papers")
+
+        results = {}
+        for key, title in titles.items():
+            # The batch query returns the papers of all its titles, so only similar whole titles match
+            match = self._best_match(title, arxiv_results, strict_similarity)
+            if match is None:
+                # The title on arXiv may differ slightly, so also search the title by relevance
+                search = arxiv.Search(query=title, max_results=1, sort_by=arxiv.SortCriterion.Relevance)
+                try:
+                    match = self._best_match(title, self.client.results(search), loose_similarity)
+                except Exception as e:
+                    logging.info(f"arXiv search failed for {title}: {e}")
+                    continue
+            results[key] = None if match is None else {"arxiv_id": match.get_short_id(), "title": match.title, "pdf_url": match.pdf_url}
+        return results
+
+    def close(self):
+        self.connection.close()
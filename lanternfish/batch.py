@@ -0,0 +1,107 @@
+import llm_api
+import google_scholar
+from generate_report import generate_report
+from pipeline import run_pipeline
+from checkpoint import paper_id
+from dedup import DedupIndex
+from evaluate_papers import evaluate_paper, prefilter_papers
+from datetime import datetime
+import dataclasses
+import asyncio
+import logging
+
+def read_prompts(path):
+    """
+    Read the prompts of a batch from a text file with one prompt per line.
+    Empty lines and lines starting with '#' are ignored.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+def run_batch(prompts, args, evaluate_options, max_chars=None):
+    """
+    Run Lanternfish for many prompts, sharing the work on papers found by several of them.
+
+    Each prompt gets its own search and abstract filter. The papers of all prompts
+    are then deduplicated (see `dedup.DedupIndex`), so that each unique paper is
+    downloaded and converted once. Every paper is evaluated for each prompt that
+    found it, and the quality review and score, which do not depend on the prompt,
+    are computed once per paper and shared. One report is generated per prompt.
+
+    Args:
+        prompts (list): The users' descriptions of what they are looking for.
+        args (argparse.Namespace): The parsed command line arguments.
+        evaluate_options (dict): Keyword arguments of `evaluate_papers.evaluate_paper`
+            other than the paper and prompt.
+        max_chars (int or None): Character budget of each paper for the conversion, see `pdf_to_markdown.convert`.
+
+    Returns:
+        list: For each prompt, the papers that were downloaded, converted and evaluated.
+    """
+    # The papers found by each prompt, by the paper id of the first paper found of its duplicates
+    papers_per_prompt = []
+    unique_papers = {}
+    index = DedupIndex()
+    for i, prompt in enumerate(prompts):
+        print(f"Prompt {i + 1} of {len(prompts)}: {prompt}")
+        papers = google_scholar.search(prompt, args.max_papers_evaluated)
+        if args.min_abstract_relevance > 0:
+            papers = llm_api.run(prefilter_papers(papers, prompt, args.min_abstract_relevance,
+                                                  args.n_samples_score, args.max_concurrency, args.score_method))
+        papers_by_id = {}
+        for paper in papers:
+            pid = paper_id(paper.scholar_info)
+            pid = index.add_if_new(paper.scholar_info, pid) or pid
+            papers_by_id.setdefault(pid, paper)
+            unique_papers.setdefault(pid, paper)
+        papers_per_prompt.append(papers_by_id)
+
+    n_papers = sum(len(papers) for papers in papers_per_prompt)
+    print(f"The {len(prompts)} prompts found {n_papers} papers, {len(unique_papers)} of them unique.")
+
+    results = [[] for _ in prompts]
+    shared_quality = {}
+    # The pipeline limits the number of papers evaluated at once, and each paper is
+    # evaluated for several prompts, so the evaluations are limited here as well
+    semaphore = asyncio.Semaphore(max(1, args.max_concurrency))
+
+    # The papers each prompt has evaluated, to skip papers that turn out to be duplicates of
+    # them once downloaded. This is done per prompt, since a paper is only a duplicate for the
+    # prompts that found both, and the others should evaluate it (with its PDF, markdown and
+    # quality review shared with its duplicate)
+    papers_evaluated = [DedupIndex() for _ in prompts]
+
+    async def evaluate_for_prompt(paper, i):
+        duplicate = papers_evaluated[i].add_if_new(paper.scholar_info, paper.title, urls=[paper.url])
+        if duplicate is not None:
+            logging.info(f"Skipping {paper.title} for prompt {i + 1}, a duplicate of {duplicate}")
+            return
+        # Each prompt gets its own copy of the paper, with its own abstract score, reviews and scores
+        prompt_paper = dataclasses.replace(papers_per_prompt[i][paper_id(paper.scholar_info)],
+                                           pdf_path=paper.pdf_path, url=paper.url, markdown_path=paper.markdown_path)
+        async with semaphore:
+            try:
+                await evaluate_paper(prompt_paper, prompts[i], shared_quality=shared_quality, **evaluate_options)
+            except Exception as e:
+                print(f"Failed to evaluate {paper.title} for prompt {i + 1}: {e}")
+                return
+        results[i].append(prompt_paper)
+
+    async def evaluate_for_prompts(paper):
+        pid = paper_id(paper.scholar_info)
+        await asyncio.gather(*(
+            evaluate_for_prompt(paper, i) for i in range(len(prompts)) if pid in papers_per_prompt[i]
+        ))
+        logging.info(f"Evaluated {paper.title} for all prompts")
+
+    llm_api.run(run_pipeline(list(unique_papers.values()), evaluate_for_prompts, args.max_concurrency, args.max_downloads,
+                             conversion_mode=args.conversion_mode, max_chars=max_chars, max_pdf_size_mb=args.max_pdf_size,
+                             deduplicate=False))
+
+    date_and_time = datetime.now().replace(microsecond=0).isoformat().replace("T", "_")
+    for i, prompt in enumerate(prompts):
+        print(f"Report for prompt {i + 1} of {len(prompts)}: {prompt}")
+        generate_report(prompt, results[i], args.top_k, report_name=f"lanternfish_report_{date_and_time}_{i + 1}")
+
+    return results
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+# The fields of a paper set by the LLM evaluation, see `evaluate_papers.evaluate_paper`
+EVALUATION_FIELDS = ["review_relevancy", "relevance_score", "review_quality", "quality_score", "total_score", "summary"]
+
+# Directory where the checkpoint files of the runs are stored
+CHECKPOINT_FOLDER = "lanternfish/runs"
+
+def checkpoint_path(run_id, folder=CHECKPOINT_FOLDER):
+    """Return the path of the checkpoint file of the run `run_id`."""
+    return os.path.join(folder, f"{run_id}.jsonl")
+
+def paper_id(paper_info):
+    """
+    Return a stable identifier of a paper from its Google Scholar info, based on
+    its title and authors.
+    """
+    bib = paper_info["bib"]
+    key = json.dumps([bib["title"].strip().lower(), bib.get("author")], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+class RunCheckpoint:
+    """
+    Persist the results of each stage of a run per paper, so that an interrupted
+    run can be resumed without redoing completed work.
+
+    Results are appended as JSON lines to "'folder'/<run_id>.jsonl" as soon as they
+    are computed. Each line holds a stage (e.g. "download"), a paper id (see
+    `paper_id`, or None for results of the whole run) and the data of the result.
+    When the file is opened again, the last result of each stage and paper is loaded.
+    """
+
+    def __init__(self, run_id=None, folder=CHECKPOINT_FOLDER):
+        """
+        Args:
+            run_id (str or None): Identifier of the run to resume. A new run is started if None.
+            folder (str): Directory where the checkpoint files are stored.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.run_id = run_id or datetime.now().replace(microsecond=0).isoformat().replace("T", "_").replace(":", "-")
+        self.path = checkpoint_path(self.run_id, folder)
+        self.results = {}
+        self._lock = threading.Lock()
+
+        if run_id is not None:
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(f"No checkpoint found for run {run_id} at {self.path}")
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be incomplete if the run was killed while writing it
+                    logging.warning(f"Skipping a corrupt line in {self.path}")
+                    continue
+                self.results[(record["stage"], record["paper_id"])] = record["data"]
+            if lines and not lines[-1].endswith("\n"):
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("\n")
+            logging.info(f"Loaded {len(self.results)} results of run {run_id}")
+
+    def get(self, stage, paper_id=None):
+        """Return the saved result of `stage` for the paper `paper_id`, or None if there is none."""
+        return self.results.get((stage, paper_id))
+
+    def save(self, stage, paper_id, data):
+        """Save the result `data` (JSON serializable dict) of `stage` for the paper `paper_id`."""
+        record = {"stage": stage, "paper_id": paper_id, "data": data}
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self.results[(stage, paper_id)] = data
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
@@ -0,0 +1,171 @@
+import re
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough number of characters per token, used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+# Sections are added to the context in this order of priority (lowest first),
+# sections matching DROPPED_SECTIONS are never added
+SECTION_PRIORITIES = [
+    (0, re.compile(r"abstract", re.IGNORECASE)),
+    (1, re.compile(r"introduction|background|motivation", re.IGNORECASE)),
+    (2, re.compile(r"conclusion|discussion|summary|future work|limitation", re.IGNORECASE)),
+    (3, re.compile(r"method|approach|model|experiment|result|evaluation|analysis", re.IGNORECASE)),
+]
+DROPPED_SECTIONS = re.compile(r"references|bibliography|acknowledg", re.IGNORECASE)
+OTHER_SECTION_PRIORITY = 4
+
+HEADING = re.compile(r"^#{1,6}\s+(.*)$")
+
+_encodings = {}
+
+def _get_encoding(model_name):
+    """Return the tiktoken encoding of `model_name`, or None if tiktoken is not installed."""
+    if tiktoken is None:
+        return None
+    if model_name not in _encodings:
+        try:
+            _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Not an OpenAI model (e.g. an Ollama model): its tokenizer is not available,
+            # so a general purpose encoding approximates its token counts
+            _encodings[model_name] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model_name]
+
+def count_tokens(text, model_name=None):
+    """
+    Count the number of tokens of `text` for the model `model_name`.
+
+    Uses tiktoken if it is installed and otherwise estimates the count from the
+    number of characters (`CHARS_PER_TOKEN`).
+    """
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens, model_name=None):
+    """Return the longest prefix of `text` with at most `max_tokens` tokens."""
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode(tokens[:max_tokens])
+
+def split_sections(markdown_text):
+    """
+    Split markdown into sections at its headings.
+
+    Returns:
+        list: (heading, text) tuples in document order, where `text` includes the
+              heading line. Text before the first heading (usually the title and
+              authors) gets the heading None.
+    """
+    sections = []
+    heading = None
+    lines = []
+    for line in markdown_text.splitlines(keepends=True):
+        match = HEADING.match(line.strip())
+        if match:
+            if lines:
+                sections.append((heading, "".join(lines)))
+            heading = match.group(1).strip()
+            lines = []
+        lines.append(line)
+    if lines:
+        sections.append((heading, "".join(lines)))
+    return sections
+
+def section_priority(heading, index):
+    """
+    Return the priority of a section (lower is more important), or None if the
+    section should be dropped. The text before the first heading (title, authors
+    and often the abstract) has the highest priority.
+    """
+    if heading is None or index == 0:
+        return 0
+    if DROPPED_SECTIONS.search(heading):
+        return None
+    for priority, pattern in SECTION_PRIORITIES:
+        if pattern.search(heading):
+            return priority
+    return OTHER_SECTION_PRIORITY
+
+def pack_context(markdown_text, max_tokens, model_name=None):
+    """
+    Select the most important sections of a paper that fit in `max_tokens` tokens.
+
+    Sections are added by priority: title and abstract, introduction, conclusion,
+    then methods and results, then everything else. References and acknowledgements
+    are dropped. The section that does not fit completely is truncated, and the
+    selected sections are returned in their original order.
+
+    Args:
+        markdown_text (str): The converted markdown of the paper.
+        max_tokens (int): The token budget of the paper in the prompt.
+        model_name (str or None): The model the tokens are counted for.
+
+    Returns:
+        str: The packed markdown.
+    """
+    sections = split_sections(markdown_text)
+    candidates = []
+    for index, (heading, text) in enumerate(sections):
+        priority = section_priority(heading, index)
+        if priority is not None:
+            candidates.append((priority, index, text))
+    candidates.sort()
+
+    selected = {}
+    remaining = max_tokens
+    for priority, index, text in candidates:
+        if remaining <= 0:
+            break
+        n_tokens = count_tokens(text, model_name)
+        if n_tokens > remaining:
+            text = truncate_to_tokens(text, remaining, model_name) + "\n\n"
+            n_tokens = remaining
+        selected[index] = text
+        remaining -= n_tokens
+
+    logging.debug(f"Packed {len(selected)} of {len(sections)} sections in {max_tokens - remaining} tokens")
+    return "".join(selected[index] for index in sorted(selected))
+
+def split_into_chunks(markdown_text, max_chars):
+    """
+    Split markdown into consecutive chunks of at most `max_chars` characters.
+
+    Chunks are cut at section boundaries where possible, then at paragraph
+    boundaries, and only paragraphs longer than `max_chars` are cut in between.
+
+    Args:
+        markdown_text (str): The converted markdown of the paper.
+        max_chars (int): Maximal number of characters of a chunk.
+
+    Returns:
+        list: The chunks (str) in document order.
+    """
+    pieces = []
+    for _, text in split_sections(markdown_text):
+        if len(text) <= max_chars:
+            pieces.append(text)
+            continue
+        for paragraph in re.split(r"(?<=\n\n)", text):
+            for start in range(0, len(paragraph), max_chars):
+                pieces.append(paragraph[start:start + max_chars])
+
+    chunks = []
+    chunk = ""
+    for piece in pieces:
+        if chunk and len(chunk) + len(piece) > max_chars:
+            chunks.append(chunk)
+            chunk = ""
+        chunk += piece
+    if chunk.strip():
+        chunks.append(chunk)
+    return chunks
@@ -0,0 +1,174 @@
+import re
+import random
+import hashlib
+import unicodedata
+
+DOI_PATTERN = re.compile(r"\b(10\.\d{4,9}/[^\s\"<>?#]+)", re.IGNORECASE)
+ARXIV_PATTERN = re.compile(r"arxiv\.org/(?:abs|pdf)/([a-z\-]+/\d{7}|\d{4}\.\d{4,5})", re.IGNORECASE)
+
+# Titles are compared as sets of character shingles of this length
+SHINGLE_SIZE = 3
+# The MinHash signature of a title has NUM_BANDS * ROWS_PER_BAND values. Titles that agree
+# on all values of at least one band are compared, which finds titles with a Jaccard
+# similarity of 0.8 with a probability of about 98.5%
+NUM_BANDS = 8
+ROWS_PER_BAND = 4
+# Minimal Jaccard similarity of the shingles of two titles of the same paper
+MIN_TITLE_SIMILARITY = 0.8
+
+# The shingles are hashed with a cryptographic hash, so XOR with a random mask is a good
+# enough random permutation of them for MinHash
+_random = random.Random(0)
+_MASKS = [_random.getrandbits(64) for _ in range(NUM_BANDS * ROWS_PER_BAND)]
+
+def normalize_title(title):
+    """Lowercase a title and reduce it to letters and digits separated by single spaces."""
+    title = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", title.lower()).split())
+
+def first_author_surname(bib):
+    """Return the normalized surname of the first author, or "" if there are no authors."""
+    authors = bib.get("author") or []
+    if isinstance(authors, str):
+        authors = authors.split(" and ")
+    if not authors:
+        return ""
+    names = normalize_title(authors[0]).split()
+    return names[-1] if names else ""
+
+def identifiers(paper_info, urls=()):
+    """
+    Return the DOI and arXiv identifiers of a paper, found in the URLs of its Google
+    Scholar info and in `urls` (e.g. the URL it was downloaded from).
+
+    Returns:
+        set: Identifiers like "doi:10.1000/xyz" and "arxiv:2101.00001" (without version).
+    """
+    sources = [paper_info.get("pub_url"), paper_info.get("eprint_url"), paper_info.get("bib", {}).get("doi"), *urls]
+    found = set()
+    for source in sources:
+        if not source:
+            continue
+        for doi in DOI_PATTERN.findall(source):
+            found.add("doi:" + re.sub(r"(\.pdf|[.,;)])+$", "", doi.lower()))
+        for arxiv_id in ARXIV_PATTERN.findall(source):
+            found.add("arxiv:" + arxiv_id.lower())
+    return found
+
+def title_numbers(normalized_title):
+    """Return the words of a normalized title that contain digits, e.g. {"2d", "2021"}."""
+    return frozenset(word for word in normalized_title.split() if any(c.isdigit() for c in word))
+
+def shingles(normalized_title):
+    """Return the set of hashed character shingles of a normalized title."""
+    if len(normalized_title) <= SHINGLE_SIZE:
+        pieces = {normalized_title}
+    else:
+        pieces = {normalized_title[i:i + SHINGLE_SIZE] for i in range(len(normalized_title) - SHINGLE_SIZE + 1)}
+    return {int.from_bytes(hashlib.blake2b(piece.encode("utf-8"), digest_size=8).digest(), "big") for piece in pieces}
+
+def minhash_bands(shingle_hashes):
+    """Return the MinHash signature of a set of shingles, split into `NUM_BANDS` hashable bands."""
+    signature = [min(h ^ mask for h in shingle_hashes) for mask in _MASKS]
+    return [tuple(signature[i:i + ROWS_PER_BAND]) for i in range(0, len(signature), ROWS_PER_BAND)]
+
+class DedupIndex:
+    """
+    Index of papers for finding duplicates, e.g. the preprint and the published
+    version of the same paper.
+
+    A paper is a duplicate of a paper in the index if
+    - they have the same normalized title and first author (looked up by hash), or
+    - they share a DOI or an arXiv id, or
+    - their titles are near-duplicates (a Jaccard similarity of their character
+      shingles of at least `MIN_TITLE_SIMILARITY`) with the same numbers in them
+      (e.g. "... in 2D" and "... in 3D" are different papers), and their first
+      authors do not differ. Candidates are found with MinHash and locality sensitive hashing, so
+      a lookup does not compare the paper with every paper in the index.
+
+    Each paper is added with a value (e.g. the paper itself or its id), which is
+    returned when a duplicate of it is looked up.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._identifiers = {}
+        self._bands = [{} for _ in range(NUM_BANDS)]
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    class _Paper:
+        # The normalized key, identifiers and MinHash of a paper, computed once per lookup
+        def __init__(self, paper_info, urls):
+            bib = paper_info["bib"]
+            title = normalize_title(bib["title"])
+            self.surname = first_author_surname(bib)
+            self.key = hashlib.sha1(f"{title}|{self.surname}".encode("utf-8")).digest()
+            self.identifiers = identifiers(paper_info, urls)
+            self.shingles = shingles(title)
+            self.numbers = title_numbers(title)
+            self.bands = minhash_bands(self.shingles)
+
+    def _find_entry(self, paper):
+        entry = self._keys.get(paper.key)
+        if entry is not None:
+            return entry
+
+        for identifier in paper.identifiers:
+            if identifier in self._identifiers:
+                return self._identifiers[identifier]
+
+        candidates = set()
+        for band, buckets in zip(paper.bands, self._bands):
+            candidates.update(buckets.get(band, ()))
+        for entry in sorted(candidates):
+            entry_shingles, entry_surname, entry_numbers, _ = self._entries[entry]
+            if paper.surname and entry_surname and paper.surname != entry_surname:
+                continue
+            if paper.numbers != entry_numbers:
+                continue
+            similarity = len(paper.shingles & entry_shingles) / len(paper.shingles | entry_shingles)
+            if similarity >= MIN_TITLE_SIMILARITY:
+                return entry
+        return None
+
+    def find(self, paper_info, urls=()):
+        """
+        Return the value of the paper in the index that `paper_info` (Google Scholar
+        info) is a duplicate of, or None if there is none.
+        """
+        entry = self._find_entry(self._Paper(paper_info, urls))
+        return None if entry is None else self._entries[entry][-1]
+
+    def add(self, paper_info, value, urls=()):
+        """Add a paper (Google Scholar info) to the index with the value returned by `find`."""
+        self._add(self._Paper(paper_info, urls), value)
+
+    def _add(self, paper, value):
+        entry = len(self._entries)
+        self._entries.append((paper.shingles, paper.surname, paper.numbers, value))
+        self._keys.setdefault(paper.key, entry)
+        for identifier in paper.identifiers:
+            self._identifiers.setdefault(identifier, entry)
+        for band, buckets in zip(paper.bands, self._bands):
+            buckets.setdefault(band, []).append(entry)
+
+    def add_if_new(self, paper_info, value, urls=()):
+        """
+        Add a paper to the index unless it is a duplicate of a paper in the index.
+        The DOI and arXiv id of a duplicate are still added, so that e.g. a preprint
+        and its published version are both found by their identifiers.
+
+        Returns:
+            The value of the paper it is a duplicate of, or None if it was added.
+        """
+        paper = self._Paper(paper_info, urls)
+        entry = self._find_entry(paper)
+        if entry is None:
+            self._add(paper, value)
+            return None
+        for identifier in paper.identifiers:
+            self._identifiers.setdefault(identifier, entry)
+        return self._entries[entry][-1]
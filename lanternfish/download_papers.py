@@ -1,47 +1,161 @@
 from common import clear_folder
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import collections
+import threading
+import hashlib
+import time
 import os
 import requests
-import arxiv
-from thefuzz import fuzz
+from requests.adapters import HTTPAdapter
+from arxiv_lookup import ArxivLookup
+from paper_store import PaperStore
+from negative_cache import NegativeCache
+from checkpoint import paper_id
+from dedup import identifiers
+from paper import Paper
+
+class HostLimiter:
+    """
+    Limit the number of concurrent requests to each host and space out the
+    start of consecutive requests to the same host by a politeness delay.
+    """
 
-def download_pdf_from_url(pdf_url, title, folder="lanternfish/papers", verbose = False):
+    def __init__(self, max_per_host=2, delay=1.0):
+        """
+        Args:
+            max_per_host (int): Maximal number of concurrent requests to a single host.
+            delay (float): Minimal number of seconds between the start of two requests to the same host.
+        """
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._semaphores = collections.defaultdict(lambda: threading.BoundedSemaphore(max_per_host))
+        self._next_start = collections.defaultdict(float)
+
+    @contextmanager
+    def limit(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            semaphore = self._semaphores[host]
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start[host])
+                self._next_start[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+# PDFs are streamed to disk in chunks of this many bytes
+CHUNK_SIZE = 64 * 1024
+# A PDF must contain the "%PDF" magic bytes within its first bytes
+PDF_MAGIC_WINDOW = 1024
+
+# Shared by all download threads so that connections to the same host are reused
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+host_limiter = HostLimiter()
+# Failed downloads and titles not found on arXiv are not retried until their backoff expires
+negative_cache = NegativeCache()
+# Shared by all download threads so that their arXiv lookups are batched and rate-limited together
+arxiv_lookup = ArxivLookup(negative_cache=negative_cache)
+# Shared by all runs on the host, so that papers are downloaded and converted only once
+paper_store = PaperStore()
+
+def download_pdf_from_url(pdf_url, aliases=(), store=None, max_size_mb=50, verbose = False):
     """
-    Download a PDF from a given URL and save it locally using a sanitized version of the title.
+    Download a PDF from a given URL into the content-addressed paper store.
 
-    The PDF is saved in the specified folder with a filename derived from the paper title,
-    where non-alphanumeric characters are replaced by underscores and truncated to 100 characters.
+    The download is skipped if the store already holds a PDF downloaded from the same
+    URL or known under one of the `aliases` of the paper. Otherwise the PDF is streamed
+    to a temporary file in chunks and only added to the store once it is complete. The
+    download is aborted as soon as the response turns out not to be a PDF (by its
+    Content-Type or because it does not start with the `%PDF` magic bytes) or to be
+    larger than `max_size_mb`. Failed downloads are recorded in the `negative_cache`,
+    and the URL is not tried again until its backoff expires.
 
     Args:
         pdf_url (str): URL pointing to the PDF file.
-        title (str): Title used to create a safe filename for saving the PDF.
-        folder (str): Directory where the PDF should be saved. Defaults to "lanternfish/papers".
+        aliases (list): Identifiers of the paper the PDF is stored under, see `paper_aliases`.
+        store (PaperStore or None): Where the PDF is saved. Defaults to the shared `paper_store`.
+        max_size_mb (float): Maximal size of the PDF in megabytes.
         verbose (bool): If True, prints progress messages. Defaults to False.
 
     Returns:
         (str or None, str or None): The path to the saved PDF file if successful, 
                                     otherwise None and the url to the PDF or None.
     """
+    store = store or paper_store
 
-    safe_title = "".join(c if c.isalnum() else "_" for c in title)[:100]
-    filepath = os.path.join(folder, f"{safe_title}.pdf")
-
-    if os.path.exists(filepath):
+    stored = store.find([f"url:{pdf_url}", *aliases])
+    if stored is not None:
         if verbose:
-            print(f"File already exists, skipping download: {filepath}")
-        return (filepath, pdf_url)
+            print(f"File already exists, skipping download: {stored['pdf_path']}")
+        store.add_aliases(stored["sha256"], aliases)
+        return (stored["pdf_path"], stored["url"])
+
+    failure_key = f"url:{pdf_url}"
+    # A PDF that was too large is only skipped while the size limit is the same
+    too_large_key = f"too_large:{max_size_mb}:{pdf_url}"
+    reason = negative_cache.skip_reason(failure_key) or negative_cache.skip_reason(too_large_key)
+    if reason is not None:
+        if verbose:
+            print(f"Skipping {pdf_url}, it failed recently: {reason}")
+        return (None, None)
+
+    def failed(reason, transient=False):
+        negative_cache.record_failure(failure_key, reason, transient=transient)
+        return (None, None)
 
+    def too_large():
+        negative_cache.record_failure(too_large_key, f"larger than {max_size_mb} MB")
+        return (None, None)
+
+    max_size = int(max_size_mb * 1024 * 1024)
+    tmp_path = None
     try:
-        response = requests.get(pdf_url, timeout=10)
-        response.raise_for_status()  
+        with host_limiter.limit(pdf_url), session.get(pdf_url, timeout=10, stream=True) as response:
+            response.raise_for_status()
 
-        content_type = response.headers.get('Content-Type', '')
-        if "pdf" not in content_type.lower():
+            # Servers often send PDFs as generic binary data, the magic bytes are checked below
+            content_type = response.headers.get('Content-Type', '').lower()
+            if "pdf" not in content_type and "octet-stream" not in content_type:
+                if verbose:
+                    print(f"URL does not point to a PDF: {pdf_url}")
+                return failed(f"Content-Type {content_type}")
+
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) > max_size:
+                print(f"PDF at {pdf_url} is larger than {max_size_mb} MB, skipping it")
+                return too_large()
+
+            sha256 = hashlib.sha256()
+            size = 0
+            head = b""
+            with store.temporary_file() as f:
+                tmp_path = f.name
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if len(head) < PDF_MAGIC_WINDOW:
+                        head += chunk[:PDF_MAGIC_WINDOW - len(head)]
+                        if len(head) >= PDF_MAGIC_WINDOW and b"%PDF" not in head:
+                            break
+                    size += len(chunk)
+                    if size > max_size:
+                        print(f"PDF at {pdf_url} is larger than {max_size_mb} MB, aborting the download")
+                        return too_large()
+                    sha256.update(chunk)
+                    f.write(chunk)
+
+        if b"%PDF" not in head:
             if verbose:
                 print(f"URL does not point to a PDF: {pdf_url}")
-            return (None, None)
+            return failed("not a PDF")
 
-        with open(filepath, "wb") as f:
-            f.write(response.content)
+        filepath = store.add_pdf_file(tmp_path, sha256.hexdigest(), pdf_url, aliases)
+        tmp_path = None
+        negative_cache.record_success(failure_key)
 
         if verbose:
             print(f"Downloaded")
@@ -49,145 +163,155 @@ def download_pdf_from_url(pdf_url, title, folder="lanternfish/papers", verbose =
 
     except Exception as e:
         print(f"Failed to download from {pdf_url}: {e}")
-        return (None, None)
+        return failed(f"{type(e).__name__}: {e}", transient=is_transient(e))
+    finally:
+        # Partial and rejected downloads are never added to the store
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 
+def is_transient(error):
+    """Whether a failed download may well succeed soon, e.g. after a timeout, a dropped connection or a 5xx response."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and (error.response.status_code == 429 or error.response.status_code >= 500)
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                              requests.exceptions.ChunkedEncodingError))
 
-def download_from_arxiv(title, folder="lanternfish/papers", similarity_threshold=80, verbose = False):
+
+def download_from_arxiv(title, aliases=(), store=None, max_size_mb=50, verbose = False):
     """
-    Search for and download a paper from arXiv using a fuzzy match on the title.
+    Find a paper on arXiv by its title and download it.
 
-    The function queries arXiv for the most relevant paper matching the provided title.
-    It then compares the returned title with the given title using token set ratio similarity.
-    If the similarity is above the specified threshold, the paper's PDF is downloaded.
+    The title is resolved to an arXiv paper by the shared `arxiv_lookup`, which
+    batches the lookups of concurrent downloads into few arXiv queries, matches
+    titles with a fuzzy similarity and caches the resolutions (including papers
+    that are not on arXiv) on disk.
 
     Args:
         title (str): The title of the paper to search for.
-        folder (str): Directory where the PDF should be saved. Defaults to "lanternfish/papers".
-        similarity_threshold (int): Minimum required similarity (0-100) between titles. Defaults to 80.
+        aliases (list): Identifiers of the paper the PDF is stored under, see `paper_aliases`.
+        store (PaperStore or None): Where the PDF is saved. Defaults to the shared `paper_store`.
+        max_size_mb (float): Maximal size of the PDF in megabytes.
         verbose (bool): If True, prints diagnostic messages during execution. Defaults to False.
 
     Returns:
-        str or None: Path to the downloaded PDF if successful, otherwise None.
+        (str or None, str or None): Path to the downloaded PDF if successful, otherwise None
+                                    and the URL used for download or None.
     """
 
-    client = arxiv.Client()
-
-    search = arxiv.Search(
-        query=title,
-        max_results=1,
-        sort_by=arxiv.SortCriterion.Relevance
-    )
-
-    try:
-        for result in client.results(search):
-            arxiv_title = result.title
-            similarity = fuzz.token_set_ratio(title.lower(), arxiv_title.lower())
-            if verbose:
-                print(f"Comparing titles:\n  Original: {title}\n  arXiv:    {arxiv_title}\n  Similarity: {similarity}%")
-
-            if similarity >= similarity_threshold:
-                pdf_url = result.pdf_url
-                if verbose:
-                    print(f"Title similarity {similarity}% >= {similarity_threshold}%.")
-                return download_pdf_from_url(pdf_url, title, folder)
-
+    result = arxiv_lookup.lookup(title)
+    if result is None:
         if verbose:
-            print(f"No arXiv papers matched the title with similarity >= {similarity_threshold}%")
-        return (None, None)
-    except Exception as e:
-        if verbose:
-            print(f"arXiv download failed for {title}: {e}")
+            print(f"No arXiv papers matched the title: {title}")
         return (None, None)
 
+    if verbose:
+        print(f"Found on arXiv:\n  Original: {title}\n  arXiv:    {result['title']}")
+    return download_pdf_from_url(result["pdf_url"], aliases, store, max_size_mb, verbose = verbose)
+
 
-def download_paper(paper, folder="lanternfish/papers", verbose = False):
+def paper_aliases(paper):
+    """Return the identifiers a paper (Google Scholar info) is stored under in the paper store."""
+    return [f"paper:{paper_id(paper)}", *sorted(identifiers(paper))]
+
+def download_paper(paper, store=None, max_size_mb=50, verbose = False):
     """
     Attempt to download a paper using its direct eprint URL, with fallback to arXiv search.
 
-    This function first tries to download the paper using the 'eprint_url' field provided
+    Nothing is downloaded if the paper store already holds the paper. Otherwise this
+    function first tries to download the paper using the 'eprint_url' field provided
     by Google Scholar. If the direct download fails or the URL is not present, it falls 
     back to searching for the paper on arXiv using a fuzzy match on the paper title.
 
     Args:
         paper (dict): A dictionary containing metadata about the paper. Expected to have a 
                       'bib' field with a 'title', and optionally an 'eprint_url' field.
-        folder (str): Directory where the PDF should be saved. Defaults to "lanternfish/papers".
+        store (PaperStore or None): Where the PDF is saved. Defaults to the shared `paper_store`.
+        max_size_mb (float): Maximal size of the PDF in megabytes.
         verbose (bool): If True, prints progress and debug information. Defaults to False.
 
     Returns:
         (str or None, str or None): Path to the downloaded PDF if successful, otherwise None 
                                     and the URL used for download or None.
     """
+    store = store or paper_store
 
     title = paper['bib']['title']
     url = paper.get('eprint_url', None)
+    aliases = paper_aliases(paper)
+
+    stored = store.find(aliases)
+    if stored is not None:
+        if verbose:
+            print(f"Paper already downloaded: {stored['pdf_path']}")
+        store.add_aliases(stored["sha256"], aliases)
+        return (stored["pdf_path"], stored["url"])
 
     if url:
         if verbose:
             print(f"Trying direct download")
-        filepath, url = download_pdf_from_url(url, title, folder, verbose = verbose)
+        filepath, url = download_pdf_from_url(url, aliases, store, max_size_mb, verbose = verbose)
         if filepath is not None:
             return (filepath, url)
         else:
             if verbose:
                 print(f"Direct download failed")
                 print(f"Trying arXiv download")
-            return download_from_arxiv(title, folder, verbose = verbose)
+            return download_from_arxiv(title, aliases, store, max_size_mb, verbose = verbose)
     else:
         if verbose:
             print(f"Trying arXiv download")
-        return download_from_arxiv(title, folder, verbose = verbose)
+        return download_from_arxiv(title, aliases, store, max_size_mb, verbose = verbose)
     
 
-def download_papers(papers, folder="lanternfish/papers", verbose=False):
+def download_papers(papers, verbose=False, max_workers=8, max_size_mb=50):
     """
     Attempt to download a list of papers and return the successfully downloaded ones.
 
     For each paper, this function first tries to download using the 'eprint_url' field 
     if available. If that fails or is missing, it falls back to a fuzzy arXiv title match.
-    Successfully downloaded PDFs are saved to the specified folder.
-    Downloads are skipped if the PDF file already exists locally, avoiding redundant downloads.
+    Successfully downloaded PDFs are saved to the shared `paper_store`.
+    Downloads are skipped if the store already holds the paper, avoiding redundant downloads.
+    Papers are downloaded concurrently by `max_workers` threads sharing one connection
+    pool, with the number of concurrent requests to each host capped by `host_limiter`.
     
 
     Args:
-        papers (list): A list of dictionaries, each representing a paper with at least a 
-                       'bib' subdictionary containing the 'title'. Optionally includes an 
-                       'eprint_url' field.
-        folder (str): Directory where the downloaded PDFs will be saved. Defaults to "lanternfish/papers".
+        papers (list): A list of `paper.Paper`.
         verbose (bool): If True, prints detailed information about each download attempt. Defaults to False.
+        max_workers (int): Maximal number of papers downloaded at the same time. Defaults to 8.
+        max_size_mb (float): Maximal size of a PDF in megabytes. Defaults to 50.
 
     Returns:
-        tuple:
-            list: The subset of `papers` that were successfully downloaded.
-            list: Paths to the corresponding successfully downloaded PDF files.
+        list: The subset of `papers` that were successfully downloaded.
     """
 
-    successful_downloads = 0
     download_attempts = len(papers)
-    successful_papers = []
-
-    if not os.path.exists(folder):
-        os.makedirs(folder)
 
     print("Downloading papers...")
 
-    for i, paper in enumerate(papers):
+    def download(i, paper):
         if verbose:
-            print(f"\nAttempting to download paper {i+1}/{download_attempts}: {paper['bib']['title']}")
-        path, url = download_paper(paper["google scholar info"], verbose=verbose)
+            print(f"\nAttempting to download paper {i+1}/{download_attempts}: {paper.title}")
+        return download_paper(paper.scholar_info, max_size_mb=max_size_mb, verbose=verbose)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = list(executor.map(download, range(download_attempts), papers))
+
+    successful_papers = []
+    for paper, (path, url) in zip(papers, results):
         if path is not None:
             if verbose:
-                print("✅ Success")
-            successful_downloads += 1
-            paper["pdf path"] = path
-            paper["url"] = url
+                print(f"✅ Success: {paper.title}")
+            paper.pdf_path = path
+            paper.url = url
             successful_papers.append(paper)
         else:
             if verbose:
-                print("❌ Failed")
+                print(f"❌ Failed: {paper.title}")
 
     print("\nDownload completed")
-    print(f"Out of a total of {download_attempts} papers, {successful_downloads} were successfully downloaded.")
+    print(f"Out of a total of {download_attempts} papers, {len(successful_papers)} were successfully downloaded.")
     return successful_papers
 
 
@@ -206,5 +330,5 @@ if __name__=="__main__":
                     # Not directly downloadable and not found in arXiv
                     ]
     
-    papers_example = download_papers(papers_example, verbose=True)
+    papers_example = download_papers([Paper(paper) for paper in papers_example], verbose=True)
 
@@ -0,0 +1,113 @@
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from openai import APIConnectionError, APIStatusError
+
+# Assumed latency in seconds of an endpoint that has not answered a request yet, low
+# enough that new endpoints get requests and their actual latency is measured
+DEFAULT_LATENCY = 1.0
+# Weight of the latest request in the moving average of the latency of an endpoint
+LATENCY_SMOOTHING = 0.2
+
+class Endpoint:
+    """An LLM server endpoint and its load: requests in flight, latency and health."""
+
+    def __init__(self, base_url, client):
+        self.base_url = base_url
+        self.client = client
+        self.in_flight = 0
+        self.latency = None
+        self.healthy = True
+        self.probe = None
+
+    def load(self):
+        """The expected time until a new request to this endpoint is answered."""
+        return (self.in_flight + 1) * (self.latency or DEFAULT_LATENCY)
+
+    def __repr__(self):
+        return f"Endpoint({self.base_url})"
+
+class EndpointPool:
+    """
+    Spread LLM requests over several OpenAI-compatible endpoints (e.g. several Ollama servers).
+
+    Each request goes to the healthy endpoint with the lowest load, i.e. the number
+    of requests it has in flight times its average latency, so that faster servers get
+    more requests. An endpoint that fails with a connection error, a timeout or a
+    server error is taken out of rotation, and probed every `probe_interval` seconds
+    until it answers again. If no endpoint is healthy, requests are sent to all of them.
+    """
+
+    def __init__(self, endpoints, probe_interval=30.0):
+        """
+        Args:
+            endpoints (list): The `Endpoint`s to spread the requests over.
+            probe_interval (float): Seconds between two health probes of a failed endpoint.
+        """
+        self.endpoints = endpoints
+        self.probe_interval = probe_interval
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def choose(self):
+        """Return the endpoint a new request should be sent to."""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+        return min(candidates, key=Endpoint.load)
+
+    @asynccontextmanager
+    async def client(self):
+        """
+        Choose an endpoint and yield its `AsyncOpenAI` client for one request, e.g.
+
+            async with pool.client() as client:
+                response = await client.chat.completions.create(...)
+
+        The latency of the request and errors raised by it update the state of the endpoint.
+        """
+        endpoint = self.choose()
+        endpoint.in_flight += 1
+        start = time.perf_counter()
+        try:
+            yield endpoint.client
+        except (APIConnectionError, APIStatusError) as e:
+            if isinstance(e, APIConnectionError) or e.status_code >= 500:
+                self._mark_unhealthy(endpoint, e)
+            raise
+        else:
+            latency = time.perf_counter() - start
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += LATENCY_SMOOTHING * (latency - endpoint.latency)
+        finally:
+            endpoint.in_flight -= 1
+
+    def _mark_unhealthy(self, endpoint, error):
+        if not endpoint.healthy or len(self.endpoints) == 1:
+            return
+        logging.warning(f"Taking LLM endpoint {endpoint.base_url} out of rotation: {error}")
+        endpoint.healthy = False
+        endpoint.probe = asyncio.ensure_future(self._probe(endpoint))
+
+    async def _probe(self, endpoint):
+        # Check the endpoint periodically until it answers, then put it back into rotation
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await endpoint.client.models.list()
+            except Exception as e:
+                logging.debug(f"LLM endpoint {endpoint.base_url} is still down: {e}")
+                continue
+            logging.warning(f"LLM endpoint {endpoint.base_url} is back in rotation")
+            endpoint.healthy = True
+            endpoint.latency = None
+            endpoint.probe = None
+            return
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            if endpoint.probe is not None:
+                endpoint.probe.cancel()
+            await endpoint.client.close()
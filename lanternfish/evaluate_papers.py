@@ -0,0 +1,193 @@
+import llm_api
+from context_packing import pack_context, split_into_chunks
+import functools
+import asyncio
+import logging
+import math
+
+ANALYSIS_MODES = ("separate", "shared_prefix", "fused")
+LONG_PAPER_MODES = ("truncate", "map_reduce")
+
+def _check_response(response, what, paper):
+    # Failed LLM requests return None, which must not be reviewed, scored or reported as text
+    if not response:
+        raise ValueError(f"The LLM returned no {what} for {paper.title}")
+    return response
+
+async def evaluate_paper(paper, prompt, max_paper_length=50000, min_relevance=0.6, min_quality=0.6, n_samples_score=1, score_method="logprobs", analysis_mode="shared_prefix", max_paper_tokens=None, long_paper_mode="truncate", shared_quality=None):
+    """
+    Review, score and summarize a single paper with respect to the user's prompt.
+
+    The steps are run in order: relevance review, relevance score, quality review,
+    quality score and summary. The chain stops early if the relevance score is below
+    `min_relevance` or the quality score is below `min_quality`, leaving the remaining
+    fields of the paper as None.
+
+    How the paper is laid out in the prompts depends on `analysis_mode`:
+    - "separate": each step has its own system message and layout.
+    - "shared_prefix": the reviews and the summary share one system message and start
+      with the paper, so the LLM server can reuse its prefix cache of the paper.
+    - "fused": a single structured call returns both reviews, both scores and the
+      summary. This pays for the paper once, but there is no early exit.
+
+    With `long_paper_mode="map_reduce"` the whole paper is split into chunks of
+    `max_paper_length` characters instead of being truncated. The reviews and the
+    summary are then written for all chunks concurrently and combined into one
+    (not supported with the "fused" analysis mode).
+
+    The quality review and quality score do not depend on the prompt. When the same
+    paper is evaluated for several prompts, passing the same `shared_quality` dict
+    to every call makes them share a single quality review and score per paper.
+
+    Args:
+        paper (Paper): A paper with a `markdown_path` to its converted markdown.
+        prompt (str): The user's description of what they are looking for.
+        max_paper_length (int): Maximum number of characters of the paper sent to the LLM.
+        min_relevance (float): Minimal relevance score needed to continue the evaluation.
+        min_quality (float): Minimal quality score needed to continue the evaluation.
+        n_samples_score (int): Number of LLM samples averaged for each score.
+        score_method (str): How scores are computed, see `llm_api.generate_score`.
+        analysis_mode (str): One of `ANALYSIS_MODES`.
+        max_paper_tokens (int or None): If given, the paper is not truncated at `max_paper_length`
+            characters, but its most important sections are packed into this many tokens
+            (see `context_packing.pack_context`).
+        long_paper_mode (str): One of `LONG_PAPER_MODES`.
+        shared_quality (dict or None): Maps the markdown path of a paper to the task
+            computing its quality review and score, shared between calls.
+
+    Returns:
+        Paper: The same paper, updated in place with reviews, scores and summary.
+
+    Raises:
+        ValueError: If an LLM request for a review, the summary or the analysis failed,
+            so that the paper is not stored with made up results.
+    """
+    if analysis_mode not in ANALYSIS_MODES:
+        raise ValueError(f"Invalid analysis mode: {analysis_mode}. Must be one of {ANALYSIS_MODES}.")
+    if long_paper_mode not in LONG_PAPER_MODES:
+        raise ValueError(f"Invalid long paper mode: {long_paper_mode}. Must be one of {LONG_PAPER_MODES}.")
+    shared_prefix = analysis_mode == "shared_prefix"
+
+    # The markdown is only held while the paper is evaluated, not stored on the paper
+    markdown_text = paper.read_markdown()
+
+    if long_paper_mode == "map_reduce" and analysis_mode != "fused":
+        chunks = split_into_chunks(markdown_text, max_paper_length)
+        review_relevancy = functools.partial(llm_api.generate_review_relevancy_map_reduce_async, prompt, chunks, shared_prefix=shared_prefix)
+        review_quality = functools.partial(llm_api.generate_review_quality_map_reduce_async, chunks, shared_prefix=shared_prefix)
+        summarize = functools.partial(llm_api.generate_summary_map_reduce_async, prompt, chunks, shared_prefix=shared_prefix)
+    else:
+        if max_paper_tokens is not None:
+            markdown_text = pack_context(markdown_text, max_paper_tokens, llm_api.llm_client.model_name)
+        else:
+            # Truncate the paper text at max_paper_length
+            markdown_text = markdown_text[:max_paper_length]
+        review_relevancy = functools.partial(llm_api.generate_review_relevancy_async, prompt, markdown_text, shared_prefix=shared_prefix)
+        review_quality = functools.partial(llm_api.generate_review_quality_async, markdown_text, shared_prefix=shared_prefix)
+        summarize = functools.partial(llm_api.generate_summary_async, prompt, markdown_text, shared_prefix=shared_prefix)
+
+    if analysis_mode == "fused":
+        return await evaluate_paper_fused(paper, prompt, markdown_text, min_relevance, min_quality)
+
+    # Review the relevancy of the paper the with respect to the prompt
+    paper.review_relevancy = _check_response(await review_relevancy(), "relevance review", paper)
+
+    # Get relevance score of the full paper
+    paper.relevance_score = await llm_api.generate_score(prompt, paper.review_relevancy, n_samples=n_samples_score, type="relevance", method=score_method)
+    if paper.relevance_score < min_relevance:
+        logging.info(f"Relevance score below threshold for: {paper.title}")
+        return paper
+
+    async def review_and_score_quality():
+        # Review the quality of the paper (normal review)
+        review = _check_response(await review_quality(), "quality review", paper)
+
+        # Get quality score
+        score = await llm_api.generate_score(prompt, review, n_samples=n_samples_score, type="quality", method=score_method)
+        return review, score
+
+    if shared_quality is None:
+        paper.review_quality, paper.quality_score = await review_and_score_quality()
+    else:
+        if paper.markdown_path not in shared_quality:
+            shared_quality[paper.markdown_path] = asyncio.ensure_future(review_and_score_quality())
+        paper.review_quality, paper.quality_score = await shared_quality[paper.markdown_path]
+    if paper.quality_score < min_quality:
+        logging.info(f"Quality score below threshold for: {paper.title}")
+        return paper
+
+    # Calc total score
+    paper.total_score = round(math.sqrt(paper.relevance_score * paper.quality_score), 1)
+
+    # Produce summaries of the papers with respect to the prompt
+    paper.summary = _check_response(await summarize(), "summary", paper)
+
+    return paper
+
+async def evaluate_paper_fused(paper, prompt, markdown_text, min_relevance=0.6, min_quality=0.6):
+    """
+    Review, score and summarize a paper with a single LLM call, see `evaluate_paper`.
+    The scores and summary are only kept if the paper passes both thresholds.
+    """
+    analysis = _check_response(await llm_api.generate_paper_analysis_async(prompt, markdown_text), "analysis", paper)
+
+    paper.review_relevancy = analysis.relevance_review
+    paper.relevance_score = analysis.relevance_score
+    if paper.relevance_score < min_relevance:
+        logging.info(f"Relevance score below threshold for: {paper.title}")
+        return paper
+
+    paper.review_quality = analysis.quality_review
+    paper.quality_score = analysis.quality_score
+    if paper.quality_score < min_quality:
+        logging.info(f"Quality score below threshold for: {paper.title}")
+        return paper
+
+    paper.total_score = round(math.sqrt(paper.relevance_score * paper.quality_score), 1)
+    paper.summary = analysis.summary
+
+    return paper
+
+async def prefilter_papers(papers, prompt, min_abstract_relevance=2.0, n_samples_score=1, max_concurrency=16, score_method="logprobs"):
+    """
+    Drop papers that are clearly irrelevant based on their title and abstract.
+
+    The abstracts returned by Google Scholar are scored concurrently against the
+    prompt, which is much cheaper than downloading, converting and reviewing the
+    full papers. Papers without an abstract are kept.
+
+    Args:
+        papers (list): Papers returned by `google_scholar.search`.
+        prompt (str): The user's description of what they are looking for.
+        min_abstract_relevance (float): Minimal relevance score of the title and abstract.
+        n_samples_score (int): Number of LLM samples averaged for each score.
+        max_concurrency (int): Maximal number of abstracts scored at the same time.
+        score_method (str): How scores are computed, see `llm_api.generate_score`.
+
+    Returns:
+        list: The papers with a relevant abstract (or without abstract), in the same order as `papers`.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def score_abstract(paper):
+        bib = paper.scholar_info["bib"]
+        abstract = bib.get("abstract")
+        if not abstract:
+            return
+        async with semaphore:
+            try:
+                paper.abstract_relevance_score = await llm_api.generate_score(
+                    prompt, f"{bib['title']}\n\n{abstract}", n_samples=n_samples_score, type="abstract", method=score_method)
+            except ValueError as e:
+                # Keep the paper, its full text is still evaluated
+                logging.warning(f"Could not score the abstract of {bib['title']}: {e}")
+
+    print("Filtering papers based on their abstracts...")
+    await asyncio.gather(*(score_abstract(paper) for paper in papers))
+
+    relevant_papers = [
+        paper for paper in papers
+        if paper.abstract_relevance_score is None or paper.abstract_relevance_score >= min_abstract_relevance
+    ]
+    print(f"Out of a total of {len(papers)} papers, {len(relevant_papers)} have a relevant abstract.")
+    return relevant_papers
@@ -1,18 +1,24 @@
 from markdown_pdf import MarkdownPdf, Section
-from llm_api import generate_title, generate_summary_overall
+import llm_api
+import asyncio
 from datetime import datetime
 
 def get_top_k_papers_sorted(papers, top_k):
     sorted_papers = sorted(
         papers,
-        key=lambda x: x['total score'] if x['total score'] is not None else float('-inf'),
+        key=lambda x: x.total_score if x.total_score is not None else float('-inf'),
         reverse=True
     )
     return sorted_papers[:top_k]
 
+async def generate_title_and_summary_overall(prompt, papers):
+    return await asyncio.gather(
+        llm_api.generate_title_async(prompt),
+        llm_api.generate_summary_overall_async(prompt, papers),
+    )
+
 def generate_report(prompt, papers, top_k, report_name=None):
     print("Generating PDF-report...")
-    title = generate_title(prompt)
 
     if report_name is None:
         date_and_time = datetime.now().replace(microsecond=0).isoformat().replace("T", "_")
@@ -22,7 +28,7 @@ def generate_report(prompt, papers, top_k, report_name=None):
 
     papers = get_top_k_papers_sorted(papers, top_k)
     
-    summary_overall = generate_summary_overall(prompt, papers)
+    title, summary_overall = llm_api.run(generate_title_and_summary_overall(prompt, papers))
 
     report_markdown = f"# {title}\n\n"
 
@@ -30,11 +36,12 @@ def generate_report(prompt, papers, top_k, report_name=None):
     n_papers = len(papers)
     report_markdown += f"*Lanternfish here presents the top {n_papers} papers.*\n\n"
 
-    report_markdown += f"{summary_overall}\n\n"
+    if summary_overall:
+        report_markdown += f"{summary_overall}\n\n"
     
     for paper in papers:
-        paper_info = paper['google scholar info']['bib']
-        report_markdown += f"## [{paper_info['title']}]({paper['url']})\n"
+        paper_info = paper.scholar_info['bib']
+        report_markdown += f"## [{paper_info['title']}]({paper.url})\n"
         report_markdown += f"*Year:* {paper_info['pub_year']} "
         if paper_info['venue']:
             report_markdown += f"*Journal:* {paper_info['venue']} "
@@ -42,10 +49,10 @@ def generate_report(prompt, papers, top_k, report_name=None):
         for author in paper_info['author']:
             report_markdown += f" {author}, "
         report_markdown = report_markdown.rstrip(", ") + "\n"
-        report_markdown += f"Total Score: **{paper['total score']}**/10 "
-        report_markdown += f"Quality Score: **{paper['quality score']}**/10 "
-        report_markdown += f"Relevance Score: **{paper['relevance score']}**/10\n\n"
-        report_markdown += f"### Summary\n{paper['summary']}\n\n"
+        report_markdown += f"Total Score: **{paper.total_score}**/10 "
+        report_markdown += f"Quality Score: **{paper.quality_score}**/10 "
+        report_markdown += f"Relevance Score: **{paper.relevance_score}**/10\n\n"
+        report_markdown += f"### Summary\n{paper.summary}\n\n"
 
     report_pdf = MarkdownPdf(optimize=True)
 
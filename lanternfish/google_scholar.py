@@ -1,19 +1,55 @@
 
 from llm_api import generate_search_prompts
+from paper import Paper
+from dedup import DedupIndex
 from scholarly import scholarly
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import logging
+import math
 from cache_to_disk import cache_to_disk
 
+# Google Scholar returns search results in pages of this size
+RESULTS_PER_PAGE = 10
+
 @cache_to_disk(1)
-def get_scholar_search_pubs(query, max_n_papers): # to cache google scholar results
-    papers = []
-    n_paper = 0
-    for paper in scholarly.search_pubs(query):
-        papers.append(paper)
-        n_paper += 1
-        if n_paper >= max_n_papers:
-            break
-    return papers
+def get_scholar_search_page(query, start_index): # to cache google scholar results
+    """Return one page of Google Scholar results for `query`, starting at result `start_index`."""
+    # Only the results of the first page are taken, so the iterator never requests a second one
+    return list(itertools.islice(scholarly.search_pubs(query, start_index=start_index), RESULTS_PER_PAGE))
+
+class ScholarResults:
+    """
+    Google Scholar results of a query, fetched lazily one page at a time.
+
+    Pages are requested in a thread pool, so that the pages of several queries are
+    fetched at the same time. Pages expected to be needed can be requested ahead
+    with `prefetch`, and further pages are only requested once they are iterated over,
+    up to `max_pages` pages.
+    """
+
+    def __init__(self, query, executor, max_pages=None):
+        self.query = query
+        self.executor = executor
+        self.max_pages = max_pages
+        self.pages = []
+
+    def prefetch(self, n_pages):
+        """Request the first `n_pages` pages of results in the background."""
+        if self.max_pages is not None:
+            n_pages = min(n_pages, self.max_pages)
+        while len(self.pages) < n_pages:
+            self.pages.append(self.executor.submit(get_scholar_search_page, self.query, len(self.pages) * RESULTS_PER_PAGE))
+
+    def __iter__(self):
+        for i in itertools.count():
+            if self.max_pages is not None and i >= self.max_pages:
+                return
+            self.prefetch(i + 1)
+            page = self.pages[i].result()
+            yield from page
+            if len(page) < RESULTS_PER_PAGE:
+                return
 
 def search(prompt, max_n_papers=50):
     """Find papers using Google Scholar.
@@ -27,61 +63,69 @@ def search(prompt, max_n_papers=50):
     results for the first search term, the next 15% are the top results from the
     second search term that is not already in the first 75%, and the last 10% are
     the top results from the third search term that is not already in the first 90%.
+    Duplicates are detected with `dedup.DedupIndex`.
 
     Args:
         prompt (str): A description of the what the user is after.
         max_n_papers (int): Maximum number of papers to return.
 
     Returns:
-        list: A list of dictionaries with information about each paper found. 
+        list: A list of `paper.Paper` with information about each paper found. 
     """
 
     print("Generate search terms for Google Scholar...")
 
-    search_queries = []
-    search_queries.append(generate_search_prompts(prompt))
-    
-    for i in range(2):
-        new_prompt = f"Description of the papers I want to find: {prompt}\n\nPrevious search queries that have missed some papers:\n"
-        for query in search_queries:
-            new_prompt += f"- {query}\n"
-        new_prompt += "Please generate a new search query that will find more relevant papers. Consider making the search less specific potentially with fewer ANDs and more ORs."
-        search_queries.append(generate_search_prompts(new_prompt))
-
-    logging_info_queries = "Search queries generated:\n"
-    for query in search_queries:
-        logging_info_queries += f"- {query}\n"
-    logging.info(logging_info_queries)
-
-    paper = {
-        "google scholar info": None,
-        "pdf path": None,
-        "url": None,
-        "markdown path": None,
-        "review relevancy": None,
-        "review quality": None,
-        "relevancy score": None,
-        "quality score": None,
-        "total score": None,
-        "summary": None,
-    }
-    papers = []
-    unique_ids = []
-
-    print("Searching Google Scholar for papers...")
-    logging.info(f"Searching Google Scholar for at most {max_n_papers} papers")
-    
+    # The share of the papers taken from the results of each search query
     current_max_n_papers = [int(max_n_papers* 0.75), int(max_n_papers * 0.90), max_n_papers]
-    for i, query in enumerate(search_queries):
-        google_scholar_hits = get_scholar_search_pubs(query, max_n_papers)
-        for paper_info in google_scholar_hits:
+
+    with ThreadPoolExecutor(max_workers=len(current_max_n_papers)) as executor:
+        # Each query is sent to Google Scholar as soon as it is generated, so the searches
+        # run while the next queries are generated and while the results are deduplicated.
+        # The pages a query needs at least to fill its share are requested right away,
+        # later pages only when duplicates of earlier results leave its share unfilled,
+        # but never more than the `max_n_papers` results of a query.
+        max_pages = math.ceil(max_n_papers / RESULTS_PER_PAGE)
+        search_queries = []
+        search_results = []
+        previous_max_n_papers = 0
+        for i, max_n_papers_query in enumerate(current_max_n_papers):
+            if i == 0:
+                query = generate_search_prompts(prompt)
+            else:
+                new_prompt = f"Description of the papers I want to find: {prompt}\n\nPrevious search queries that have missed some papers:\n"
+                for query in search_queries:
+                    new_prompt += f"- {query}\n"
+                new_prompt += "Please generate a new search query that will find more relevant papers. Consider making the search less specific potentially with fewer ANDs and more ORs."
+                query = generate_search_prompts(new_prompt)
+            search_queries.append(query)
+            results = ScholarResults(query, executor, max_pages)
+            results.prefetch(math.ceil((max_n_papers_query - previous_max_n_papers) / RESULTS_PER_PAGE))
+            search_results.append(results)
+            previous_max_n_papers = max_n_papers_query
+
+        logging_info_queries = "Search queries generated:\n"
+        for query in search_queries:
+            logging_info_queries += f"- {query}\n"
+        logging.info(logging_info_queries)
+
+        papers = []
+        # Also catches e.g. the preprint and the published version of a paper
+        index = DedupIndex()
+
+        print("Searching Google Scholar for papers...")
+        logging.info(f"Searching Google Scholar for at most {max_n_papers} papers")
+
+        for i, results in enumerate(search_results):
             if len(papers) >= current_max_n_papers[i]:
-                break
-            unique_id = (paper_info['bib']['title'], paper_info['bib']['author'])
-            if (unique_id not in unique_ids):
-                papers.append(paper.copy())
-                papers[-1]["google scholar info"] = paper_info
-                unique_ids.append(unique_id)
+                continue
+            for paper_info in results:
+                if index.add_if_new(paper_info, len(papers)) is None:
+                    papers.append(Paper(paper_info))
+                if len(papers) >= current_max_n_papers[i]:
+                    break
+
+        # Do not wait for pages that were requested but are not needed
+        executor.shutdown(wait=False, cancel_futures=True)
 
     logging.info(f"Found {len(papers)} papers")
     
@@ -94,4 +138,4 @@ if __name__ == "__main__":
     papers = search(prompt,  max_n_papers=10)
     print("Search results:")
     for paper in papers:
-        print(f"Title: {paper['google scholar info']['bib']['title']}")
+        print(f"Title: {paper.title}")
@@ -1,11 +1,49 @@
 from llm_client import AsyncLLMClient
+from llm_cache import LLMCache
 import asyncio
+import atexit
 
-from prompts import SYSTEM_GENERATE_QUERY, SYSTEM_GENERATE_RELEVANCE_SCORE, SYSTEM_GENERATE_QUALITY_SCORE, SYSTEM_GENERATE_SUMMARY, SYSTEM_GENERATE_TITLE, SYSTEM_GENERATE_REVIEW_QUALITY, system_generate_review_relevancy
+from prompts import SYSTEM_GENERATE_QUERY, SYSTEM_GENERATE_RELEVANCE_SCORE, SYSTEM_GENERATE_ABSTRACT_RELEVANCE_SCORE, SYSTEM_GENERATE_QUALITY_SCORE, SYSTEM_GENERATE_SUMMARY, SYSTEM_GENERATE_TITLE, SYSTEM_GENERATE_REVIEW_QUALITY, system_generate_review_relevancy
+from prompts import SYSTEM_ANALYZE_PAPER, TASK_REVIEW_QUALITY, shared_prefix_prompt, task_generate_summary, task_analyze_paper, system_combine_parts
 import logging
 from pydantic import BaseModel
 
-llm_client = AsyncLLMClient()
+llm_client = AsyncLLMClient(cache=LLMCache())
+
+# A single long-lived event loop shared by all synchronous calls, so that the
+# HTTP connection pool of `llm_client` stays bound to one loop and is reused.
+_runner = asyncio.Runner()
+
+def run(coroutine):
+    """
+    Run a coroutine to completion on the shared event loop of the module.
+
+    Use this instead of `asyncio.run` for anything awaiting `llm_client`, since
+    `asyncio.run` creates and closes a new event loop on every call.
+
+    Args:
+        coroutine (coroutine): The coroutine to run.
+
+    Returns:
+        The result of the coroutine.
+    """
+    return _runner.run(coroutine)
+
+def disable_cache():
+    """Bypass the persistent LLM response cache for the rest of the run."""
+    if llm_client.cache is not None:
+        llm_client.cache.close()
+        llm_client.cache = None
+
+def _close():
+    try:
+        _runner.run(llm_client.close())
+    finally:
+        _runner.close()
+        if llm_client.cache is not None:
+            llm_client.cache.close()
+
+atexit.register(_close)
 
 class Score(BaseModel):
     score: int
@@ -13,29 +51,46 @@ class Score(BaseModel):
 class Title(BaseModel):
     title: str
 
+class PaperAnalysis(BaseModel):
+    relevance_review: str
+    relevance_score: int
+    quality_review: str
+    quality_score: int
+    summary: str
+
+async def generate_search_prompts_async(user_prompt):
+    query = await llm_client.get_completion(user_prompt,
+                                            system_message=SYSTEM_GENERATE_QUERY, temperature=0.0)
+    if not query:
+        raise ValueError("The LLM did not generate a search query.")
+    return query
+
 def generate_search_prompts(user_prompt):
-    return asyncio.run(
-        llm_client.get_completion(user_prompt,
-                                  system_message=SYSTEM_GENERATE_QUERY, temperature=0.0)
-    )
+    return run(generate_search_prompts_async(user_prompt))
 
-async def generate_score(user_prompt, paper_info, n_samples=1, type="relevance"):
+async def generate_score(user_prompt, paper_info, n_samples=1, type="relevance", method="logprobs"):
     """
     Generate a relevance or quality score for a paper or review using an LLM.
 
-    The function sends a prompt to a language model `n_samples` times and computes the
+    With `method="logprobs"` the function makes a single call and computes the expected
+    score from the probabilities the model assigns to each score token. If the server
+    does not return logprobs, it falls back to sampling. With `method="sampling"` the
+    function sends a prompt to a language model `n_samples` times and computes the
     average score returned by the model. For relevance scoring, the prompt consists of
     the user's search intent and the paper information. For quality scoring, the prompt
-    uses review content instead. The score must be an integer between 0 and 9 (inclusive).
+    uses review content instead. For abstract scoring, the prompt consists of the user's
+    search intent and the title and abstract of the paper. The score must be an integer
+    between 0 and 9 (inclusive).
 
     Args:
         user_prompt (str): The user's query or task description.
-        paper_info (str): LaTeX-formatted paper metadata or review content.
+        paper_info (str): LaTeX-formatted paper metadata, review content or title and abstract.
         n_samples (int): Number of times to query the model to average out the score. Default is 1.
-        type (str): Type of score to generate, either "relevance" or "quality".
+        type (str): Type of score to generate, either "relevance", "quality" or "abstract".
+        method (str): How to compute the score, either "logprobs" or "sampling".
 
     Returns:
-        float: The average score returned by the LLM across `n_samples` calls.
+        float: The expected score, or the average score returned by the LLM across `n_samples` calls.
 
     Raises:
         ValueError: If the `type` is invalid or no valid scores are returned.
@@ -47,8 +102,20 @@ async def generate_score(user_prompt, paper_info, n_samples=1, type="relevance")
     elif type == "quality":
         complete_prompt = f"Review: {paper_info}"
         system_message = SYSTEM_GENERATE_QUALITY_SCORE
+    elif type == "abstract":
+        complete_prompt = f"User prompt:\n{user_prompt}\n\nTitle and abstract:\n{paper_info}"
+        system_message = SYSTEM_GENERATE_ABSTRACT_RELEVANCE_SCORE
     else:
-        raise ValueError(f"Invalid type: {type}. Must be 'relevance' or 'quality'.")
+        raise ValueError(f"Invalid type: {type}. Must be 'relevance', 'quality' or 'abstract'.")
+
+    if method == "logprobs":
+        distribution = await llm_client.get_score_distribution(complete_prompt, system_message, Score)
+        if distribution is not None:
+            score = sum(score * probability for score, probability in distribution.items())
+            logging.info(f"Expected score {score:.2f}")
+            return score
+    elif method != "sampling":
+        raise ValueError(f"Invalid method: {method}. Must be 'logprobs' or 'sampling'.")
 
     tasks = [
         llm_client.get_completion(
@@ -56,25 +123,25 @@ async def generate_score(user_prompt, paper_info, n_samples=1, type="relevance")
             system_message=system_message,
             #max_tokens=1,
             response_format=Score,
+            sample=i,
         )
-        for _ in range(n_samples)
+        for i in range(n_samples)
     ]
 
     responses = await asyncio.gather(*tasks)
-    responses = [r.score for r in responses]
 
     scores = []
     for response in responses:
-        if response is not None:
-            try:
-                score = response
-                if 0 <= score <= 9:
-                    scores.append(score)
-                    logging.info(f"Score {score}")
-                else:
-                    print(f"Invalid score (out of range): {score}")
-            except ValueError:
-                print(f"Invalid score (non-integer): {response}")
+        # Failed requests return None and refusals a string instead of a Score
+        if not isinstance(response, Score):
+            logging.warning(f"No score in the LLM response: {response}")
+            continue
+        score = response.score
+        if 0 <= score <= 9:
+            scores.append(score)
+            logging.info(f"Score {score}")
+        else:
+            print(f"Invalid score (out of range): {score}")
 
     if not scores:
         raise ValueError("No valid scores returned by the LLM. Remember to set a sufficient context length.")
@@ -82,30 +149,34 @@ async def generate_score(user_prompt, paper_info, n_samples=1, type="relevance")
     return sum(scores) / len(scores)
 
 
-def generate_summary(user_prompt, paper_latex, verbose=False):
+async def generate_summary_async(user_prompt, paper_latex, verbose=False, shared_prefix=False):
     """
     Generate a summary of a paper's transcription tailored to the user's prompt using the LLM.
 
     Args:
-        transcription (str): The full markdown text transcription of the paper.
         user_prompt (str): The prompt describing the field/context for tailoring the summary.
+        paper_latex (str): The full markdown text transcription of the paper.
         verbose (bool): Whether to print debug info.
+        shared_prefix (bool): Lay out the prompt with the paper first (see `prompts.shared_prefix_prompt`).
 
     Returns:
         str: The generated summary from the LLM.
     """
 
-    # Combine the transcription and user prompt into the message to the model
-    full_prompt = f"Paper content:\n{paper_latex}\n\nUser prompt:\n{user_prompt}"
+    if shared_prefix:
+        full_prompt = shared_prefix_prompt(paper_latex, task_generate_summary(user_prompt))
+        system_message = SYSTEM_ANALYZE_PAPER
+    else:
+        # Combine the transcription and user prompt into the message to the model
+        full_prompt = f"Paper content:\n{paper_latex}\n\nUser prompt:\n{user_prompt}"
+        system_message = SYSTEM_GENERATE_SUMMARY
 
     if verbose:
         print("Generating summary with LLM...")
 
-    summary = asyncio.run(
-        llm_client.get_completion(
-            full_prompt,
-            system_message=SYSTEM_GENERATE_SUMMARY
-        )
+    summary = await llm_client.get_completion(
+        full_prompt,
+        system_message=system_message
     )
 
     if verbose:
@@ -113,31 +184,126 @@ def generate_summary(user_prompt, paper_latex, verbose=False):
 
     return summary
 
-def generate_review_relevancy(user_prompt, paper_text):
+def generate_summary(user_prompt, paper_latex, verbose=False):
+    return run(generate_summary_async(user_prompt, paper_latex, verbose=verbose))
+
+async def generate_review_relevancy_async(user_prompt, paper_text, shared_prefix=False):
     
-    review = asyncio.run(llm_client.get_completion(
-        paper_text,
-        system_message=system_generate_review_relevancy(user_prompt),
-    ))
+    if shared_prefix:
+        review = await llm_client.get_completion(
+            shared_prefix_prompt(paper_text, system_generate_review_relevancy(user_prompt)),
+            system_message=SYSTEM_ANALYZE_PAPER,
+        )
+    else:
+        review = await llm_client.get_completion(
+            paper_text,
+            system_message=system_generate_review_relevancy(user_prompt),
+        )
     
     logging.info("Review of relevancy generated")
     logging.debug(f"Review relevancy content: {review}")
     
     return review
 
-def generate_review_quality(paper_text):
+def generate_review_relevancy(user_prompt, paper_text):
+    return run(generate_review_relevancy_async(user_prompt, paper_text))
+
+async def generate_review_quality_async(paper_text, shared_prefix=False):
     
-    review = asyncio.run(llm_client.get_completion(
-        paper_text,
-        system_message=SYSTEM_GENERATE_REVIEW_QUALITY,
-    ))
+    if shared_prefix:
+        review = await llm_client.get_completion(
+            shared_prefix_prompt(paper_text, TASK_REVIEW_QUALITY),
+            system_message=SYSTEM_ANALYZE_PAPER,
+        )
+    else:
+        review = await llm_client.get_completion(
+            paper_text,
+            system_message=SYSTEM_GENERATE_REVIEW_QUALITY,
+        )
     
     logging.info("Review generated")
     logging.debug(f"Review quality content: {review}")
     
     return review
 
-def generate_title(user_prompt):
+def generate_review_quality(paper_text):
+    return run(generate_review_quality_async(paper_text))
+
+async def map_reduce_async(map_function, chunks, result, instructions):
+    """
+    Apply `map_function` to the chunks of a long paper concurrently and combine the
+    partial results into one with the LLM.
+
+    Args:
+        map_function (coroutine function): Called with each chunk (str), returns a partial result (str).
+        chunks (list): Consecutive chunks of the paper, see `context_packing.split_into_chunks`.
+        result (str): Name of the result, e.g. "summary", used in the prompt for combining.
+        instructions (str): The instructions the partial results were written with.
+
+    Returns:
+        str: The combined result.
+    """
+    partial_results = await asyncio.gather(*(map_function(chunk) for chunk in chunks))
+    partial_results = [partial_result for partial_result in partial_results if partial_result]
+    if len(partial_results) <= 1:
+        return partial_results[0] if partial_results else None
+
+    logging.info(f"Combining {len(partial_results)} partial {result}s")
+    prompt = "\n\n".join(
+        f"Part {i+1} of {len(partial_results)}:\n{partial_result}" for i, partial_result in enumerate(partial_results)
+    )
+    return await llm_client.get_completion(
+        prompt,
+        system_message=system_combine_parts(result, instructions),
+    )
+
+async def generate_review_relevancy_map_reduce_async(user_prompt, chunks, shared_prefix=False):
+    return await map_reduce_async(
+        lambda chunk: generate_review_relevancy_async(user_prompt, chunk, shared_prefix=shared_prefix),
+        chunks, "review", system_generate_review_relevancy(user_prompt),
+    )
+
+async def generate_review_quality_map_reduce_async(chunks, shared_prefix=False):
+    return await map_reduce_async(
+        lambda chunk: generate_review_quality_async(chunk, shared_prefix=shared_prefix),
+        chunks, "review", TASK_REVIEW_QUALITY,
+    )
+
+async def generate_summary_map_reduce_async(user_prompt, chunks, shared_prefix=False):
+    return await map_reduce_async(
+        lambda chunk: generate_summary_async(user_prompt, chunk, shared_prefix=shared_prefix),
+        chunks, "summary", task_generate_summary(user_prompt),
+    )
+
+async def generate_paper_analysis_async(user_prompt, paper_text):
+    """
+    Review, score and summarize a paper in a single structured LLM call.
+
+    This replaces the two reviews, two scores and the summary of a paper, so the
+    (long) paper only has to be processed once by the LLM.
+
+    Args:
+        user_prompt (str): The user's query or task description.
+        paper_text (str): The markdown text of the paper.
+
+    Returns:
+        PaperAnalysis or None: The reviews, scores (clamped to 0-9) and summary, or None on failure.
+    """
+    analysis = await llm_client.get_completion(
+        shared_prefix_prompt(paper_text, task_analyze_paper(user_prompt)),
+        system_message=SYSTEM_ANALYZE_PAPER,
+        response_format=PaperAnalysis,
+    )
+    if not isinstance(analysis, PaperAnalysis):
+        logging.error(f"Paper analysis failed: {analysis}")
+        return None
+
+    analysis.relevance_score = min(max(analysis.relevance_score, 0), 9)
+    analysis.quality_score = min(max(analysis.quality_score, 0), 9)
+    logging.info("Paper analysis generated")
+    return analysis
+
+async def generate_title_async(user_prompt):
     """
     Generate a title for a paper based on the user's prompt using the LLM.
 
@@ -145,28 +311,33 @@ def generate_title(user_prompt):
         user_prompt (str): The prompt describing the field/context for generating the title.
 
     Returns:
-        str: The generated title from the LLM.
+        str: The generated title from the LLM, or the prompt if no title was generated.
     """
-    respone = asyncio.run(
-        llm_client.get_completion(
-            user_prompt,
-            system_message=SYSTEM_GENERATE_TITLE,
-            response_format=Title,
-        )
+    respone = await llm_client.get_completion(
+        user_prompt,
+        system_message=SYSTEM_GENERATE_TITLE,
+        response_format=Title,
     )
 
+    if not isinstance(respone, Title):
+        logging.warning(f"No title in the LLM response: {respone}")
+        return user_prompt
     return respone.title
 
-def generate_summary_overall(user_prompt, papers):
+def generate_title(user_prompt):
+    return run(generate_title_async(user_prompt))
+
+async def generate_summary_overall_async(user_prompt, papers):
     paper_titles_and_summaries = ""
     for paper in papers:
-        paper_titles_and_summaries += f"Title:\n {paper['google scholar info']['bib']['title']}\n\nSummary:\n {paper['summary']}\n\n"
+        paper_titles_and_summaries += f"Title:\n {paper.title}\n\nSummary:\n {paper.summary}\n\n"
 
     prompt = f"\nPapers in report:\n{paper_titles_and_summaries}\n\nUser prompt:\n{user_prompt}\n\nNow write a single paragraph with the most important information from the papers in the report, tailored to the user's prompt. (Nothing else, just the single paragraph.)"
 
-    return asyncio.run(
-        llm_client.get_completion(
-            prompt,
-            system_message=SYSTEM_GENERATE_SUMMARY
-        )
+    return await llm_client.get_completion(
+        prompt,
+        system_message=SYSTEM_GENERATE_SUMMARY
     )
+
+def generate_summary_overall(user_prompt, papers):
+    return run(generate_summary_overall_async(user_prompt, papers))
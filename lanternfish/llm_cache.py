@@ -0,0 +1,136 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+
+class LLMCache:
+    """
+    Persistent, content-addressed cache of LLM responses stored in SQLite.
+
+    Responses are keyed on a hash of everything that determines the answer of the
+    model: model name, system message, prompt, temperature, max_tokens and the JSON
+    schema of the response format. Entries older than `max_age_days` are ignored
+    and removed, and the least recently used entries are evicted once the cache
+    holds more than `max_size_mb` megabytes of responses.
+    """
+
+    def __init__(self, path="lanternfish/cache/llm_cache.sqlite", max_size_mb=500, max_age_days=30):
+        """
+        Open (or create) the cache database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            max_size_mb (float): Maximal total size of the cached responses in megabytes.
+            max_age_days (float): Maximal age of a cached response in days.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self._n_writes = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model, system_message, prompt, temperature, max_tokens, response_format=None, sample=0, logprobs=False):
+        """
+        Compute the cache key of a request.
+
+        Requests with a temperature other than 0 are sampled, so `sample` is part of
+        their key. This keeps the `n` samples of a score as `n` separate entries
+        instead of returning the same answer `n` times. Requests for the token
+        probabilities of a response (`logprobs`) are cached separately from the
+        response itself.
+
+        Returns:
+            str: Hex digest identifying the request.
+        """
+        schema = None
+        if response_format is not None:
+            schema = response_format.model_json_schema()
+
+        parts = {
+            "model": model,
+            "system_message": system_message,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "response_schema": schema,
+        }
+        if temperature != 0:
+            parts["sample"] = sample
+        if logprobs:
+            parts["logprobs"] = True
+
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None on a miss."""
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT value, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None or now - row[1] > self.max_age_seconds:
+            self.misses += 1
+            return None
+
+        self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self.connection.commit()
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, value):
+        """Store the response `value` (str) under `key`."""
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value.encode("utf-8")), now, now),
+        )
+        self.connection.commit()
+
+        self._n_writes += 1
+        if self._n_writes % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries and the least recently used entries above the size limit."""
+        self.connection.execute(
+            "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_seconds,)
+        )
+
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size > self.max_size_bytes:
+            rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+            to_delete = []
+            for key, size in rows:
+                if total_size <= self.max_size_bytes:
+                    break
+                to_delete.append((key,))
+                total_size -= size
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+            logging.info(f"Evicted {len(to_delete)} responses from the LLM cache")
+
+        self.connection.commit()
+
+    def stats(self):
+        return f"LLM cache: {self.hits} hits, {self.misses} misses"
+
+    def close(self):
+        self.connection.close()
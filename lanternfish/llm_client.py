@@ -7,10 +7,26 @@ import logging
 import subprocess
 import sys
 import time, signal
+import json
+import math
+import functools
+import multiprocessing
 import ollama
+from endpoint_pool import Endpoint, EndpointPool
+from request_governor import RequestGovernor
+from llm_cache import LLMCache
 
 class AsyncLLMClient:
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        Args:
+            cache (LLMCache or None): Persistent response cache. No caching if None.
+        """
+        self.cache = cache
+        # Responses of the requests in flight by their cache key, see `_coalesce`
+        self._in_flight = {}
+        # Set to False once the server has answered without token logprobs
+        self.logprobs_supported = True
         self.server_ip = os.getenv("LLM_SERVER_IP")
         self.server_port = os.getenv("LLM_SERVER_PORT")
         self.model_name = os.getenv("CLI_MODEL_NAME",os.getenv("LLM_MODEL_NAME"))
@@ -18,39 +34,112 @@ class AsyncLLMClient:
         
         self.local_ollama=None
 
-        if os.getenv("START_LOCAL_OLLAMA"):
+        # Worker processes (e.g. of the PDF conversion) import this module as well, but
+        # must not start, pull models to or stop the Ollama server
+        manage_ollama = multiprocessing.parent_process() is None
+
+        if os.getenv("START_LOCAL_OLLAMA") and manage_ollama:
             self.local_ollama = LocalOllama(self.model_name, self.server_port)
             atexit.register(self.local_ollama._stop_ollama_server)
 
-        if os.getenv("USE_LOCAL_OLLAMA"):
-            logging.info(f"Checking if {self.model_name}. Is available at ollama")
-            client = ollama.Client(host=f"http://{self.server_ip}:{self.server_port}")
-            if not any(model.model.startswith(self.model_name) for model in client.list().models):
-                logging.info(f"Downloading the Ollama model {self.model_name}. This may take a while...")
-                client.pull(model=self.model_name)
-
-        custom_base_url = None
-        if self.server_ip and self.server_port:
-            custom_base_url = f"http://{self.server_ip}:{self.server_port}/v1"
-            logging.info(f"Using custom LLM endpoint: {custom_base_url}")
+        if os.getenv("LLM_ENDPOINTS"):
+            base_urls = [_endpoint_url(endpoint) for endpoint in os.getenv("LLM_ENDPOINTS").split(",") if endpoint.strip()]
+            logging.info(f"Spreading LLM requests over {len(base_urls)} endpoints: {', '.join(base_urls)}")
+        elif self.server_ip and self.server_port:
+            base_urls = [f"http://{self.server_ip}:{self.server_port}/v1"]
+            logging.info(f"Using custom LLM endpoint: {base_urls[0]}")
         elif os.getenv("OPENAI_API_BASE"):
-            custom_base_url = os.getenv("OPENAI_API_BASE")
-            logging.info(f"Using OpenAI base URL from OPENAI_API_BASE: {custom_base_url}")
+            base_urls = [os.getenv("OPENAI_API_BASE")]
+            logging.info(f"Using OpenAI base URL from OPENAI_API_BASE: {base_urls[0]}")
         else:
+            base_urls = [None]
             logging.info("Using default OpenAI API endpoint.")
 
+        if os.getenv("USE_LOCAL_OLLAMA") and manage_ollama:
+            for base_url in filter(None, base_urls):
+                host = base_url.removesuffix("/").removesuffix("/v1")
+                logging.info(f"Checking if {self.model_name}. Is available at ollama on {host}")
+                client = ollama.Client(host=host)
+                if not any(model.model.startswith(self.model_name) for model in client.list().models):
+                    logging.info(f"Downloading the Ollama model {self.model_name}. This may take a while...")
+                    client.pull(model=self.model_name)
+
+        # Retries are left to the governor, which may send them to another endpoint
+        timeout = float(os.getenv("LLM_TIMEOUT", 600))
+        max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 16 * len(base_urls)))
+        self.governor = RequestGovernor(initial_limit=min(4 * len(base_urls), max_concurrency), max_limit=max_concurrency)
+
         try:
-            # Use AsyncOpenAI instead of OpenAI
-            self.client = AsyncOpenAI(
-                api_key=self.api_key,
-                base_url=custom_base_url
-            )
+            # One AsyncOpenAI client per endpoint, each request is sent to the least loaded one
+            self.endpoints = EndpointPool([
+                Endpoint(base_url, AsyncOpenAI(api_key=self.api_key, base_url=base_url, timeout=timeout, max_retries=0))
+                for base_url in base_urls
+            ])
         except OpenAIError as e: # Note: OpenAIError might not be specific to async initialization
             logging.error(f"Error initializing AsyncOpenAI client: {e}")
-            self.client = None
+            self.endpoints = None
+
+    async def get_completion(self, prompt: str, system_message: str = "You are a helpful assistant.", max_tokens: int = 8000,  temperature = None, response_format=None, sample: int = 0) -> str | None:
+        """
+        Get a completion from the LLM, served from the response cache or shared with an
+        identical request in flight (see `_coalesce`) when possible.
+
+        Args:
+            prompt (str): The user message.
+            system_message (str): The system message.
+            max_tokens (int): Maximal number of tokens in the completion.
+            temperature (float or None): Sampling temperature. None uses the server default.
+            response_format (type[BaseModel] or None): Pydantic model for structured output.
+            sample (int): Index of the sample when the same request is sampled several
+                times, so that independent samples are cached separately.
+
+        Returns:
+            str, BaseModel or None: The completion, the parsed structured output or None on failure.
+        """
+        key = LLMCache.make_key(self.model_name, system_message, prompt, temperature, max_tokens, response_format, sample)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logging.debug("LLM response served from cache")
+                if response_format is None:
+                    return cached
+                return response_format.model_validate_json(cached)
 
-    async def get_completion(self, prompt: str, system_message: str = "You are a helpful assistant.", max_tokens: int = 8000,  temperature = None, response_format=None) -> str | None:
-        if not self.client:
+        async def get_and_cache_completion():
+            response = await self._get_completion(prompt, system_message, max_tokens, temperature, response_format)
+            if self.cache is None:
+                return response
+            if response_format is None and isinstance(response, str):
+                self.cache.set(key, response)
+            elif response_format is not None and isinstance(response, response_format):
+                self.cache.set(key, response.model_dump_json())
+            return response
+
+        return await self._coalesce(key, get_and_cache_completion)
+
+    async def _coalesce(self, key, request):
+        """
+        Await `request()`, or the response of an identical request that is already in
+        flight, so that identical requests issued at the same time (e.g. the same
+        paper reviewed for two prompts of a batch) are only sent once.
+
+        Requests are identical if their cache keys are (see `LLMCache.make_key`). The key
+        of a request with a temperature other than 0 contains its sample index, so the
+        independent samples of a score are still sent separately, while the samples of
+        a temperature 0 request, which would all be the same, are sent once.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(request())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            logging.debug("Identical LLM request already in flight, waiting for its response")
+        # A cancelled caller must not cancel the request for the others waiting for it
+        return await asyncio.shield(task)
+
+    async def _get_completion(self, prompt, system_message, max_tokens, temperature, response_format):
+        if not self.endpoints:
             logging.error("AsyncLLMClient is not initialized. Cannot get completion.")
             return None
 
@@ -61,16 +150,15 @@ class AsyncLLMClient:
             ]
             
             if response_format is None:
-                # Use await for the asynchronous API call
-                response = await self.client.chat.completions.create(
-                    model=self.model_name,
+                response = await self._request(
+                    "text",
                     temperature=temperature,
                     messages=messages,
                     max_tokens=max_tokens
                 )
             else:
-                response = await self.client.beta.chat.completions.parse(
-                    model=self.model_name,
+                response = await self._request(
+                    response_format.__name__,
                     temperature=temperature,
                     messages=messages,
                     response_format=response_format,
@@ -102,17 +190,130 @@ class AsyncLLMClient:
             logging.error(f"An unexpected error occurred: {e}")
             return None
 
+    async def get_score_distribution(self, prompt: str, system_message: str, response_format, max_tokens: int = 20) -> dict | None:
+        """
+        Get the probability distribution of a single digit score (0-9) in one call.
+
+        The structured response (e.g. `{"score": 7}`) is requested together with the
+        log probabilities of the most likely tokens at each position. The distribution
+        of the score is read from the alternatives of the first digit token.
+
+        Args:
+            prompt (str): The user message.
+            system_message (str): The system message, asking for a score from 0 to 9.
+            response_format (type[BaseModel]): Pydantic model of the structured score.
+            max_tokens (int): Maximal number of tokens in the completion.
+
+        Returns:
+            dict or None: Maps each score to its probability, or None if the server did
+                not return logprobs or the response contained no score.
+        """
+        if not self.endpoints or not self.logprobs_supported:
+            return None
+
+        key = LLMCache.make_key(self.model_name, system_message, prompt, None, max_tokens, response_format, logprobs=True)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return {int(score): probability for score, probability in json.loads(cached).items()}
+
+        return await self._coalesce(
+            key, functools.partial(self._get_score_distribution, key, prompt, system_message, response_format, max_tokens)
+        )
+
+    async def _get_score_distribution(self, key, prompt, system_message, response_format, max_tokens):
+        messages = [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ]
+        try:
+            response = await self._request(
+                "logprobs",
+                messages=messages,
+                response_format=response_format,
+                max_tokens=max_tokens,
+                logprobs=True,
+                top_logprobs=10,
+            )
+        except OpenAIError as e:
+            logging.error(f"Error during LLM API call: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"An unexpected error occurred: {e}")
+            return None
+
+        if not response.choices or response.choices[0].logprobs is None or not response.choices[0].logprobs.content:
+            logging.info("The LLM server did not return logprobs, falling back to sampling scores.")
+            self.logprobs_supported = False
+            return None
+
+        distribution = _digit_distribution(response.choices[0].logprobs.content)
+        if distribution is None:
+            logging.info("No score token found in the logprobs of the response.")
+            return None
+
+        if self.cache is not None:
+            self.cache.set(key, json.dumps(distribution))
+        return distribution
+
+    async def _request(self, kind, **kwargs):
+        """
+        Send a chat completion request to the least loaded endpoint, within the adaptive
+        concurrency limit and retried on transient errors (see `RequestGovernor`).
+        The response is parsed into `response_format` if it is given.
+        """
+        async def request():
+            async with self.endpoints.client() as client:
+                if "response_format" in kwargs:
+                    return await client.beta.chat.completions.parse(model=self.model_name, **kwargs)
+                return await client.chat.completions.create(model=self.model_name, **kwargs)
+
+        # Latencies are only compared between requests with prompts of similar length (within a factor of 2)
+        prompt_length = sum(len(message["content"]) for message in kwargs["messages"])
+        return await self.governor.run(request, (kind, kwargs.get("max_tokens"), prompt_length.bit_length()))
+
     async def close(self):
         """
-        Closes the underlying HTTPX client session.
+        Closes the underlying HTTPX client sessions of all endpoints.
         It's good practice to call this when the client is no longer needed,
         especially in long-running applications.
         """
-        if self.client:
-            await self.client.close()
+        if self.endpoints:
+            await self.endpoints.close()
             logging.info("AsyncLLMClient session closed.")
 
 
+def _endpoint_url(endpoint):
+    """Return the base URL of an endpoint given as a URL or as "host:port" of an Ollama server."""
+    endpoint = endpoint.strip()
+    if "://" in endpoint:
+        return endpoint
+    return f"http://{endpoint}/v1"
+
+
+def _digit_distribution(logprobs_content):
+    """
+    Return the normalized probabilities of the digits 0-9 at the first token of a
+    response that is a digit, or None if there is no such token.
+    """
+    for token_logprob in logprobs_content:
+        token = token_logprob.token.strip()
+        if len(token) != 1 or not token.isdigit():
+            continue
+
+        probabilities = {}
+        for alternative in token_logprob.top_logprobs or [token_logprob]:
+            token = alternative.token.strip()
+            if len(token) == 1 and token.isdigit():
+                probabilities[int(token)] = probabilities.get(int(token), 0.0) + math.exp(alternative.logprob)
+
+        total = sum(probabilities.values())
+        if total <= 0:
+            return None
+        return {score: probability / total for score, probability in probabilities.items()}
+    return None
+
+
 class LocalOllama:
     """LLM wrapper class for Ollama with async support."""
 
@@ -206,7 +407,7 @@ async def main():
     # Instantiate the client
     llm_client = AsyncLLMClient()
 
-    if llm_client.client: 
+    if llm_client.endpoints:
         user_prompt = "Explain why bayesians are the worst thing happening to statistics ever."
         print(f"\nUser Prompt: {user_prompt}")
 
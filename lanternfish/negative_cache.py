@@ -0,0 +1,80 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+class NegativeCache:
+    """
+    Persistent record of lookups that failed (e.g. a dead PDF URL or a title that
+    is not on arXiv), so that they are not retried on every run.
+
+    Failures are keyed by a string such as "url:<url>" or "arxiv:<normalized title>".
+    After a failure the key is skipped for `base_ttl_hours`, or `transient_ttl_hours`
+    if the failure may well go away soon (e.g. a timeout or a 503 response), and each
+    further failure doubles that time (exponential backoff) up to `max_ttl_days`.
+    A success clears it.
+    """
+
+    def __init__(self, path="lanternfish/cache/negative_cache.sqlite", base_ttl_hours=24, transient_ttl_hours=0.25, max_ttl_days=30):
+        """
+        Args:
+            path (str): Path to the SQLite database file.
+            base_ttl_hours (float): Number of hours a key is skipped after its first failure.
+            transient_ttl_hours (float): Number of hours a key is skipped after its first transient failure.
+            max_ttl_days (float): Maximal number of days a key is skipped after a failure.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.base_ttl_seconds = base_ttl_hours * 60 * 60
+        self.transient_ttl_seconds = transient_ttl_hours * 60 * 60
+        self.max_ttl_seconds = max_ttl_days * 24 * 60 * 60
+        self._lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS failures ("
+            "key TEXT PRIMARY KEY, reason TEXT, n_failures INTEGER NOT NULL, "
+            "last_failure REAL NOT NULL, retry_after REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def skip_reason(self, key):
+        """Return the reason of the last failure of `key` if it should not be retried yet, otherwise None."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT reason, retry_after FROM failures WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() >= row[1]:
+            return None
+        return row[0]
+
+    def record_failure(self, key, reason, transient=False):
+        """
+        Record a failure of `key`, doubling the time until it is retried. A `transient`
+        failure (e.g. a timeout) starts from `transient_ttl_hours` instead of `base_ttl_hours`.
+        """
+        now = time.time()
+        base_ttl_seconds = self.transient_ttl_seconds if transient else self.base_ttl_seconds
+        with self._lock:
+            row = self.connection.execute("SELECT n_failures FROM failures WHERE key = ?", (key,)).fetchone()
+            n_failures = 1 if row is None else row[0] + 1
+            ttl = min(base_ttl_seconds * 2 ** (n_failures - 1), self.max_ttl_seconds)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO failures (key, reason, n_failures, last_failure, retry_after) VALUES (?, ?, ?, ?, ?)",
+                (key, reason, n_failures, now, now + ttl),
+            )
+            self.connection.commit()
+        logging.info(f"{key} failed {n_failures} times ({reason}), retrying in {ttl / 3600:.2f} h")
+
+    def record_success(self, key):
+        """Forget the failures of `key`."""
+        with self._lock:
+            self.connection.execute("DELETE FROM failures WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,48 @@
+from dataclasses import dataclass, asdict, fields
+
+@dataclass(slots=True)
+class Paper:
+    """
+    A paper found on Google Scholar and the results of each stage of its evaluation.
+
+    The converted markdown is not kept on the paper: stages that need it read it
+    from `markdown_path` with `read_markdown` and drop it when they are done, so
+    the memory used per paper does not grow with the length of the paper.
+    """
+    scholar_info: dict
+    abstract_relevance_score: float | None = None
+    pdf_path: str | None = None
+    url: str | None = None
+    markdown_path: str | None = None
+    review_relevancy: str | None = None
+    review_quality: str | None = None
+    relevance_score: float | None = None
+    quality_score: float | None = None
+    total_score: float | None = None
+    summary: str | None = None
+
+    @property
+    def title(self):
+        return self.scholar_info["bib"]["title"]
+
+    def read_markdown(self):
+        """Read the converted markdown of the paper from `markdown_path`."""
+        with open(self.markdown_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def to_dict(self, field_names=None):
+        """Return the fields `field_names` (all fields if None) as a JSON serializable dict."""
+        if field_names is None:
+            return asdict(self)
+        return {name: getattr(self, name) for name in field_names}
+
+    def update(self, data):
+        """Set the fields of the paper from a dict returned by `to_dict`."""
+        for name, value in data.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a paper from a dict returned by `to_dict`, ignoring unknown keys."""
+        names = {field.name for field in fields(cls)}
+        return cls(**{name: value for name, value in data.items() if name in names})
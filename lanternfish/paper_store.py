@@ -0,0 +1,119 @@
+from dedup import identifiers
+import threading
+import tempfile
+import sqlite3
+import time
+import os
+
+class PaperStore:
+    """
+    Content-addressed store of downloaded PDFs and their converted markdown, shared
+    by all runs (and users) that use the same store directory.
+
+    Each PDF is saved once as "'root'/pdfs/<sha256 of its bytes>.pdf", no matter
+    under how many titles or URLs it was found, and its markdown is converted to
+    "'root'/markdown/<sha256>/output.md". A SQLite index maps aliases of a paper
+    (its DOI, arXiv id, the URLs it was downloaded from and its Google Scholar
+    paper id, see `checkpoint.paper_id`) to the PDF, so that a paper found again
+    by any run is not downloaded again. PDFs are downloaded to a temporary file and
+    renamed once complete, so concurrent runs never see partially written PDFs, and
+    a PDF is converted by one run at a time (see `pdf_to_markdown.conversion_lock`).
+    """
+
+    def __init__(self, root=None):
+        """
+        Args:
+            root (str or None): Directory of the store. Defaults to the environment variable
+                LANTERNFISH_PAPER_STORE, or "lanternfish/paper_store" if it is not set.
+        """
+        root = root or os.environ.get("LANTERNFISH_PAPER_STORE", "lanternfish/paper_store")
+        self.root = root
+        self.pdf_dir = os.path.join(root, "pdfs")
+        self.markdown_dir = os.path.join(root, "markdown")
+        os.makedirs(self.pdf_dir, exist_ok=True)
+        os.makedirs(self.markdown_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Other runs may be writing to the index at the same time, so wait for their locks
+        self.connection = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS papers ("
+            "sha256 TEXT PRIMARY KEY, url TEXT, size INTEGER NOT NULL, markdown_path TEXT, created REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+        self.connection.commit()
+
+    def pdf_path(self, sha256):
+        return os.path.join(self.pdf_dir, f"{sha256}.pdf")
+
+    def find(self, aliases):
+        """
+        Find a stored PDF by any of its `aliases`.
+
+        Returns:
+            dict or None: The 'sha256', 'pdf_path', 'url' and 'markdown_path' (None if not
+                          converted yet) of the stored PDF, or None if none of the aliases is known.
+        """
+        with self._lock:
+            for alias in aliases:
+                row = self.connection.execute(
+                    "SELECT p.sha256, p.url, p.markdown_path FROM aliases a JOIN papers p ON a.sha256 = p.sha256 WHERE a.alias = ?",
+                    (alias,),
+                ).fetchone()
+                if row is not None and os.path.exists(self.pdf_path(row[0])):
+                    return {"sha256": row[0], "pdf_path": self.pdf_path(row[0]), "url": row[1], "markdown_path": row[2]}
+        return None
+
+    def add_aliases(self, sha256, aliases):
+        """Make the stored PDF with hash `sha256` findable by `aliases` as well."""
+        with self._lock:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO aliases (alias, sha256) VALUES (?, ?)", [(alias, sha256) for alias in aliases]
+            )
+            self.connection.commit()
+
+    def temporary_file(self):
+        """
+        Return a new temporary file (opened for binary writing) to download a PDF into
+        before it is added with `add_pdf_file`. It is in the store, so that adding it
+        is an atomic rename.
+        """
+        return tempfile.NamedTemporaryFile(dir=self.pdf_dir, suffix=".tmp", delete=False)
+
+    def add_pdf_file(self, tmp_path, sha256, url, aliases=()):
+        """
+        Store the PDF downloaded from `url` to the temporary file `tmp_path` (see
+        `temporary_file`), whose bytes have the hash `sha256`. The temporary file is
+        moved into the store, or removed if the store already holds the PDF.
+
+        The URL and the DOI or arXiv id in it are added to the `aliases` of the PDF.
+
+        Returns:
+            str: Path to the stored PDF.
+        """
+        path = self.pdf_path(sha256)
+        size = os.path.getsize(tmp_path)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO papers (sha256, url, size, created) VALUES (?, ?, ?, ?)",
+                (sha256, url, size, time.time()),
+            )
+            self.connection.commit()
+        self.add_aliases(sha256, [*aliases, f"url:{url}", *identifiers({}, [url])])
+        return path
+
+    def set_markdown(self, pdf_path, markdown_path):
+        """Record that the stored PDF at `pdf_path` was converted to `markdown_path`."""
+        sha256 = os.path.basename(pdf_path).removesuffix(".pdf")
+        with self._lock:
+            self.connection.execute("UPDATE papers SET markdown_path = ? WHERE sha256 = ?", (markdown_path, sha256))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
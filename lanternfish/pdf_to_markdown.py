@@ -1,83 +1,365 @@
 from pix2text import Pix2Text
-import multiprocessing
-import functools
+from PIL import Image
+import pymupdf
+import collections
+import tempfile
+import json
 import os
 import sys
+import time
 import logging
 from contextlib import redirect_stdout, redirect_stderr
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def convert_all(papers, output_dir="lanternfish/converted_papers", processes=10, silent=True):
+# "fast" only uses the embedded text layer of the PDF, "hybrid" uses the text layer and
+# Pix2Text for scanned pages and equations, and "full" recognizes every page with Pix2Text.
+# The modes are ordered from the lowest to the highest quality of the markdown
+CONVERSION_MODES = ("fast", "hybrid", "full")
+
+# Pages with fewer characters in their text layer are treated as scanned
+MIN_TEXT_LAYER_CHARS = 200
+# Text blocks where more than this fraction of the characters use math fonts are treated as equations
+MIN_EQUATION_MATH_FRACTION = 0.3
+MATH_FONTS = ("cmmi", "cmsy", "cmex", "msbm", "msam", "math", "symbol", "stix", "euclid")
+
+# Pages are converted until the markdown is this fraction longer than the character budget of the paper
+CHAR_BUDGET_MARGIN = 0.1
+
+# The Pix2Text model of this process, loaded once and reused for every PDF it converts
+_p2t = None
+
+def get_model():
+    """
+    Return the Pix2Text model of the current process, loading it on first use.
+
+    Returns:
+        Pix2Text: The layout, OCR and formula model used for the conversion.
     """
-    Convert a list of PDF files to markdown with equations in latex and saves
-    the files in 'output_dir'.
+    global _p2t
+    if _p2t is None:
+        start = time.perf_counter()
+        _p2t = Pix2Text.from_config(enable_formula=True)
+        logging.info(f"Loaded Pix2Text in {time.perf_counter() - start:.1f} s (pid {os.getpid()})")
+    return _p2t
+
+def init_worker(silent=True, conversion_mode="full"):
+    """
+    Initializer for conversion worker processes that loads the Pix2Text model
+    up front, so it is loaded once per process instead of once per PDF.
+
+    In "fast" and "hybrid" mode the model is not loaded up front, since most papers
+    never need it. It is then loaded on first use by `get_model`.
 
     Args:
-        paths_pdf (list): List of paths to the PDF files to convert.
-        output_dir (str): Directory where converted markdown files will be saved.
-        processes (int): Number of processes to use for conversion.
+        silent (bool): If True, the output of pix2text while loading is suppressed.
+        conversion_mode (str): One of `CONVERSION_MODES`.
+    """
+    if conversion_mode != "full":
+        return
+    if silent:
+        with open(os.devnull, 'w') as fnull:
+            with redirect_stdout(fnull), redirect_stderr(fnull):
+                get_model()
+    else:
+        get_model()
+
+def markdown_path(path_pdf, output_dir="lanternfish/converted_papers"):
+    """
+    Return the path of the markdown file converted from 'path_pdf', that is
+    "'output_dir'/<pdf_filename>/output.md", creating its directory if needed.
+
+    Args:
+        path_pdf (str): The path to the PDF file.
+        output_dir (str): Directory where converted markdown files are saved.
 
     Returns:
-        list: Paths to converted files.
+        str: Path to the markdown file (which may not exist yet).
     """
-    print("Converting PDFs of papers to markdown...")
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    pdf_filename = os.path.basename(path_pdf)
+    md_dir = os.path.join(output_dir, f"{pdf_filename}").removesuffix(".pdf")
+    if not os.path.exists(md_dir):
+        os.makedirs(md_dir)
+    return os.path.join(md_dir, "output.md")
 
-    paths_pdf_to_convert = []
-    papers_converted = []
-    for paper in papers:
-        path_pdf = paper["pdf path"]
-        pdf_filename = os.path.basename(path_pdf)
-        md_dir = os.path.join(output_dir, f"{pdf_filename}").removesuffix(".pdf")
-        if not os.path.exists(md_dir):
-            os.makedirs(md_dir)
-        md_path = os.path.join(md_dir, "output.md")
-        paper["markdown path"] = md_path
-        papers_converted.append(paper)
-        if not os.path.exists(md_path):
-            paths_pdf_to_convert.append(path_pdf)
-
-    with multiprocessing.Pool(processes=processes) as pool:
-        if silent:
-            convert_func = functools.partial(silent_convert, output_dir=output_dir)
-        else:
-            convert_func = functools.partial(convert, output_dir=output_dir)
-        pool.map(convert_func, paths_pdf_to_convert)
-    
-    return papers_converted
+def read_progress(md_path):
+    """
+    Return the conversion progress recorded next to the markdown file 'md_path',
+    or None if there is no record (e.g. files converted by older versions).
+
+    An unreadable record is treated as a conversion that has to start over.
+
+    Returns:
+        dict or None: With the keys 'pages_converted', 'page_count', 'chars' (length of
+                      the markdown of the converted pages), 'complete' and 'conversion_mode'.
+    """
+    progress_path = os.path.join(os.path.dirname(md_path), "progress.json")
+    if not os.path.exists(progress_path):
+        return None
+    try:
+        with open(progress_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Unreadable conversion progress {progress_path}, converting again: {e}")
+        return {"pages_converted": 0, "page_count": None, "chars": 0, "complete": False, "conversion_mode": None}
+
+def write_progress(md_path, progress):
+    """Record the conversion progress of the markdown file 'md_path' (see `read_progress`) atomically."""
+    progress_path = os.path.join(os.path.dirname(md_path), "progress.json")
+    write_atomically(progress_path, json.dumps(progress))
+
+def write_atomically(path, text):
+    """Write `text` to a temporary file and rename it to `path`, so that `path` is never partially written."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def is_weaker_mode(conversion_mode, other_mode):
+    """Whether `conversion_mode` produces lower quality markdown than `other_mode`. An unknown mode is the weakest."""
+    rank = CONVERSION_MODES.index(conversion_mode) if conversion_mode in CONVERSION_MODES else -1
+    return rank < CONVERSION_MODES.index(other_mode)
+
+def needs_conversion(md_path, max_chars=None, conversion_mode=None):
+    """
+    Check if the markdown file 'md_path' has to be (further) converted.
+
+    This is the case if it does not exist, if it was converted in a lower quality
+    mode than `conversion_mode`, or if an earlier conversion stopped at a smaller
+    character budget than `max_chars` before reaching the end of the PDF.
+
+    Args:
+        md_path (str): Path to the markdown file, see `markdown_path`.
+        max_chars (int or None): Character budget of the paper. No limit if None.
+        conversion_mode (str or None): One of `CONVERSION_MODES`. Any mode is accepted if None.
 
-def silent_convert(args, output_dir):
+    Returns:
+        bool: True if `convert` should be run for the paper.
+    """
+    if not os.path.exists(md_path):
+        return True
+    progress = read_progress(md_path)
+    if progress is None:
+        return False
+    if conversion_mode is not None and is_weaker_mode(progress.get("conversion_mode"), conversion_mode):
+        return True
+    if progress["complete"]:
+        return False
+    if max_chars is None:
+        return True
+    with open(md_path, "r", encoding="utf-8") as f:
+        return len(f.read()) < max_chars * (1 + CHAR_BUDGET_MARGIN)
+
+def silent_convert(args, output_dir, conversion_mode="hybrid", max_chars=None):
     with open(os.devnull, 'w') as fnull:
         with redirect_stdout(fnull), redirect_stderr(fnull):
-            return convert(args, output_dir)
+            return convert(args, output_dir, conversion_mode, max_chars)
 
-def convert(path_pdf, output_dir="lanternfish/converted_papers"):
+def convert(path_pdf, output_dir="lanternfish/converted_papers", conversion_mode="hybrid", max_chars=None):
     """
     Convert a PDF file to markdown with equations in latex and saves the file
     as "'output_dir'/<pdf_filename>/output.md".
 
+    Most born-digital PDFs have an embedded text layer that is much faster to
+    extract than recognizing the rendered pages. Depending on `conversion_mode`:
+    - "fast": only the text layer is used.
+    - "hybrid": the text layer is used, while pages without a text layer (scanned
+      pages) are recognized with Pix2Text and text blocks set in math fonts are
+      recognized as LaTeX formulas.
+    - "full": every page is recognized with Pix2Text.
+
+    The PDF is converted page by page and the conversion stops once the markdown
+    is longer than `max_chars` (plus `CHAR_BUDGET_MARGIN`), since the rest would be
+    truncated before it is sent to the LLM anyway. How far the conversion got is
+    recorded in "progress.json" next to the markdown, and a later call with a
+    larger budget continues from the first page not yet converted. Markdown
+    converted in a lower quality mode is converted again from the first page.
+
     Args:
         path_pdf (str): The path to the PDF file to convert.
+        output_dir (str): Directory where converted markdown files will be saved.
+        conversion_mode (str): One of `CONVERSION_MODES`.
+        max_chars (int or None): Character budget of the markdown. No limit if None.
 
     Returns:
         str: The markdown representation of the PDF content.
     """
+    if conversion_mode not in CONVERSION_MODES:
+        raise ValueError(f"Invalid conversion mode: {conversion_mode}. Must be one of {CONVERSION_MODES}.")
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    pdf_filename = os.path.basename(path_pdf)
-    md_dir = os.path.join(output_dir, f"{pdf_filename}").removesuffix(".pdf")
-    if not os.path.exists(md_dir):
-        os.makedirs(md_dir)
+    md_path = markdown_path(path_pdf, output_dir)
+    with conversion_lock(os.path.dirname(md_path)):
+        # Another run may have converted the paper while this one was waiting for the lock
+        if not needs_conversion(md_path, max_chars, conversion_mode):
+            with open(md_path, "r", encoding="utf-8") as f:
+                return f.read()
+        return convert_pages(path_pdf, md_path, conversion_mode, max_chars)
+
+@contextlib.contextmanager
+def conversion_lock(md_dir):
+    """
+    Hold the lock of the conversion of the markdown in `md_dir`, so that runs sharing
+    a paper store do not convert the same PDF at the same time. The lock is released
+    by the operating system if the process dies. Without `fcntl` (on Windows) there
+    is no lock, and concurrent conversions only write the same markdown twice.
+    """
+    with open(os.path.join(md_dir, "conversion.lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def convert_pages(path_pdf, md_path, conversion_mode, max_chars):
+    """Convert the pages of a PDF that are not converted yet to 'md_path', see `convert`."""
+    md_dir = os.path.dirname(md_path)
+
+    # Continue a conversion that was stopped by a smaller budget, unless it was made in
+    # another mode, so that the markdown does not mix pages converted in two modes
+    progress = read_progress(md_path)
+    if (progress is not None and not progress["complete"] and os.path.exists(md_path)
+            and progress.get("conversion_mode") == conversion_mode):
+        with open(md_path, "r", encoding="utf-8") as f:
+            markdown = f.read()
+        # The markdown may be ahead of the progress if the process stopped between writing the two
+        markdown = markdown[:progress.get("chars", len(markdown))]
+        first_page = progress["pages_converted"]
+    else:
+        markdown = ""
+        first_page = 0
+
+    budget = None if max_chars is None else int(max_chars * (1 + CHAR_BUDGET_MARGIN))
+
+    start = time.perf_counter()
+    with pymupdf.open(path_pdf) as document:
+        page_count = document.page_count
+        body_size = body_font_size(document)
+        pages_converted = first_page
+        # Mark the conversion as unfinished, so that a stopped conversion is never taken as complete
+        write_progress(md_path, {
+            "pages_converted": first_page,
+            "page_count": page_count,
+            "chars": len(markdown),
+            "complete": False,
+            "conversion_mode": conversion_mode,
+        })
+        for page in document.pages(first_page, page_count):
+            if budget is not None and len(markdown) >= budget:
+                break
+            page_markdown = convert_page(path_pdf, page, md_dir, body_size, conversion_mode)
+            if page_markdown.strip():
+                markdown = f"{markdown}\n\n{page_markdown}" if markdown else page_markdown
+            pages_converted += 1
+
+    # Write to a temporary file first so an interrupted conversion never leaves a partial output.md
+    write_atomically(md_path, markdown)
+    write_progress(md_path, {
+        "pages_converted": pages_converted,
+        "page_count": page_count,
+        "chars": len(markdown),
+        "complete": pages_converted >= page_count,
+        "conversion_mode": conversion_mode,
+    })
 
-    p2t = Pix2Text.from_config(enable_formula=True)
-    doc = p2t.recognize_pdf(
-        path_pdf,
-        table_as_image=True,
-    )
-    markdown = doc.to_markdown(md_dir)
+    logging.info(f"Converted pages {first_page + 1}-{pages_converted} of {page_count} of {path_pdf} in {time.perf_counter() - start:.1f} s ({conversion_mode})")
     
     return markdown
 
+def convert_page(path_pdf, page, md_dir, body_size, conversion_mode="hybrid"):
+    """
+    Convert a single page of a PDF to markdown, see `convert`.
+
+    Args:
+        path_pdf (str): The path to the PDF file.
+        page (pymupdf.Page): The page to convert.
+        md_dir (str): Directory where the markdown and its figures are saved.
+        body_size (float): Font size of the body text of the document, see `body_font_size`.
+        conversion_mode (str): One of `CONVERSION_MODES`.
+
+    Returns:
+        str: The markdown of the page.
+    """
+    if conversion_mode == "full":
+        return recognize_page(path_pdf, page, md_dir)
+
+    page_dict = page.get_text("dict")
+    n_chars = sum(n for n, _ in map(block_char_counts, page_dict["blocks"]))
+    if conversion_mode == "hybrid" and n_chars < MIN_TEXT_LAYER_CHARS:
+        logging.debug(f"No text layer on page {page.number} of {path_pdf}, using Pix2Text")
+        return recognize_page(path_pdf, page, md_dir)
+
+    paragraphs = []
+    for block in page_dict["blocks"]:
+        n_chars, n_math_chars = block_char_counts(block)
+        if n_chars == 0:
+            continue
+        if conversion_mode == "hybrid" and n_math_chars / n_chars > MIN_EQUATION_MATH_FRACTION:
+            paragraphs.append(recognize_formula(page, block["bbox"]))
+        else:
+            paragraphs.append(block_to_markdown(block, body_size))
+    return "\n\n".join(paragraphs)
+
+def block_char_counts(block):
+    """Return the number of characters and the number of characters in math fonts of a text block."""
+    n_chars = 0
+    n_math_chars = 0
+    for line in block.get("lines", []):
+        for span in line["spans"]:
+            n = len(span["text"].strip())
+            n_chars += n
+            if any(font in span["font"].lower() for font in MATH_FONTS):
+                n_math_chars += n
+    return n_chars, n_math_chars
+
+def block_to_markdown(block, body_size):
+    """
+    Convert a text block of the text layer to a markdown paragraph. Short blocks
+    set in a font noticeably larger than the body text are turned into headings.
+    """
+    text = ""
+    for line in block["lines"]:
+        line_text = "".join(span["text"] for span in line["spans"]).strip()
+        if text.endswith("-"):
+            text = text[:-1] + line_text
+        elif line_text:
+            text = f"{text} {line_text}" if text else line_text
+
+    size = max(span["size"] for line in block["lines"] for span in line["spans"])
+    if len(text) < 120 and size >= 1.15 * body_size:
+        return f"## {text}"
+    return text
+
+def body_font_size(document, n_pages=5):
+    """Return the most common font size (weighted by characters) in the first pages of a document."""
+    sizes = collections.Counter()
+    for page in document.pages(0, min(n_pages, document.page_count)):
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    sizes[round(span["size"] * 2) / 2] += len(span["text"].strip())
+    if not sizes:
+        return 10.0
+    return sizes.most_common(1)[0][0]
+
+def recognize_page(path_pdf, page, md_dir):
+    """Recognize a whole page of a PDF with Pix2Text and return its markdown."""
+    doc = get_model().recognize_pdf(path_pdf, page_numbers=[page.number], table_as_image=True)
+    # Figures are saved in `md_dir`, but the markdown is only written by `convert`, not to output.md
+    return doc.to_markdown(md_dir, markdown_fn=None)
+
+def recognize_formula(page, bbox, dpi=200):
+    """Recognize the region `bbox` of a page as a LaTeX formula with Pix2Text."""
+    pixmap = page.get_pixmap(clip=pymupdf.Rect(bbox), dpi=dpi)
+    image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    latex = get_model().recognize_formula(image)
+    return f"$$\n{latex}\n$$"
+
 
 if __name__ == "__main__":
     # Example usage
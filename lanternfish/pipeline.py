@@ -0,0 +1,153 @@
+import download_papers
+import pdf_to_markdown
+from checkpoint import paper_id, EVALUATION_FIELDS
+from dedup import DedupIndex
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import functools
+import asyncio
+import logging
+import time
+import os
+
+async def run_pipeline(papers, evaluate, max_concurrency=4, max_downloads=8, processes=10, queue_size=8,
+                       conversion_mode="hybrid", max_chars=None, max_pdf_size_mb=50, checkpoint=None, output_dir=None, silent=True,
+                       deduplicate=True):
+    """
+    Download, convert and evaluate papers as a streaming pipeline.
+
+    Each paper is passed on to conversion as soon as its PDF is downloaded and to
+    the LLM evaluation as soon as its markdown exists, so that network, CPU
+    (pix2text) and LLM work overlap. The stages are connected by bounded queues
+    of size `queue_size`, which keeps a fast stage from running far ahead of a
+    slow one. A paper that turns out to be a duplicate of a paper downloaded before
+    (e.g. both were downloaded from the same arXiv id) is not converted or evaluated,
+    unless `deduplicate` is False.
+
+    If a `checkpoint` is given, the results of the download and evaluation of each
+    paper are saved as soon as they are done, and papers with saved results are not
+    downloaded or evaluated again. Converted papers are kept on disk anyway.
+
+    Args:
+        papers (list): Papers returned by `google_scholar.search`.
+        evaluate (coroutine function): Called with each converted paper, e.g.
+            `evaluate_papers.evaluate_paper` with its other arguments bound by `functools.partial`.
+        max_concurrency (int): Maximal number of papers evaluated at the same time.
+        max_downloads (int): Maximal number of papers downloaded at the same time.
+        processes (int): Number of processes used for the PDF conversion.
+        queue_size (int): Maximal number of papers waiting between two stages.
+        conversion_mode (str): One of `pdf_to_markdown.CONVERSION_MODES`.
+        max_chars (int or None): Character budget of each paper for the conversion, see `pdf_to_markdown.convert`.
+        max_pdf_size_mb (float): Maximal size of a downloaded PDF in megabytes.
+        checkpoint (RunCheckpoint or None): Where the results of the run are saved and resumed from.
+        output_dir (str or None): Directory where the converted markdown files are saved.
+            Defaults to the markdown directory of the shared `download_papers.paper_store`.
+        silent (bool): If True, the output of pix2text is suppressed.
+        deduplicate (bool): Whether papers that turn out to be duplicates once downloaded are
+            skipped. `evaluate` gets them (with the PDF and markdown shared by the paper store)
+            if False, e.g. when it evaluates each paper for several prompts, see `batch.run_batch`.
+
+    Returns:
+        list: The papers that were downloaded, converted and evaluated.
+    """
+    output_dir = output_dir or download_papers.paper_store.markdown_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    max_downloads = max(1, max_downloads)
+    max_concurrency = max(1, max_concurrency)
+    processes = max(1, processes)
+
+    papers_to_download = asyncio.Queue()
+    for paper in papers:
+        papers_to_download.put_nowait(paper)
+    papers_to_convert = asyncio.Queue(maxsize=queue_size)
+    papers_to_evaluate = asyncio.Queue(maxsize=queue_size)
+    papers_evaluated = []
+    # Papers that only turn out to be duplicates once downloaded, e.g. when both were found on arXiv
+    papers_downloaded = DedupIndex()
+
+    if silent:
+        convert_func = functools.partial(pdf_to_markdown.silent_convert, output_dir=output_dir, conversion_mode=conversion_mode, max_chars=max_chars)
+    else:
+        convert_func = functools.partial(pdf_to_markdown.convert, output_dir=output_dir, conversion_mode=conversion_mode, max_chars=max_chars)
+
+    async def download_worker():
+        while not papers_to_download.empty():
+            paper = papers_to_download.get_nowait()
+            try:
+                saved = checkpoint.get("download", paper_id(paper.scholar_info)) if checkpoint else None
+                if saved is not None and (saved["pdf_path"] is None or os.path.exists(saved["pdf_path"])):
+                    path, url = saved["pdf_path"], saved["url"]
+                else:
+                    path, url = await asyncio.to_thread(download_papers.download_paper, paper.scholar_info, max_size_mb=max_pdf_size_mb)
+                    if checkpoint:
+                        checkpoint.save("download", paper_id(paper.scholar_info), {"pdf_path": path, "url": url})
+            except Exception as e:
+                # Keep going with the other papers, a resumed run tries this one again
+                print(f"Failed to download {paper.title}: {e}")
+                continue
+            if path is None:
+                logging.info(f"Download failed: {paper.title}")
+                continue
+            duplicate = papers_downloaded.add_if_new(paper.scholar_info, paper.title, urls=[url]) if deduplicate else None
+            if duplicate is not None:
+                logging.info(f"Skipping {paper.title}, a duplicate of {duplicate}")
+                continue
+            paper.pdf_path = path
+            paper.url = url
+            await papers_to_convert.put(paper)
+
+    async def convert_worker(pool):
+        loop = asyncio.get_running_loop()
+        while (paper := await papers_to_convert.get()) is not None:
+            try:
+                md_path = pdf_to_markdown.markdown_path(paper.pdf_path, output_dir)
+                if pdf_to_markdown.needs_conversion(md_path, max_chars, conversion_mode):
+                    start = time.perf_counter()
+                    await loop.run_in_executor(pool, convert_func, paper.pdf_path)
+                    logging.info(f"Converted {paper.pdf_path} in {time.perf_counter() - start:.1f} s")
+                    download_papers.paper_store.set_markdown(paper.pdf_path, md_path)
+            except Exception as e:
+                print(f"Failed to convert {paper.pdf_path}: {e}")
+                continue
+            paper.markdown_path = md_path
+            await papers_to_evaluate.put(paper)
+
+    async def evaluate_worker():
+        while (paper := await papers_to_evaluate.get()) is not None:
+            saved = checkpoint.get("evaluate", paper_id(paper.scholar_info)) if checkpoint else None
+            if saved is not None:
+                paper.update(saved)
+            else:
+                try:
+                    await evaluate(paper)
+                except Exception as e:
+                    # Keep going with the other papers, a resumed run tries this one again
+                    print(f"Failed to evaluate {paper.title}: {e}")
+                    continue
+                if checkpoint:
+                    checkpoint.save("evaluate", paper_id(paper.scholar_info), paper.to_dict(EVALUATION_FIELDS))
+            papers_evaluated.append(paper)
+
+    async def run_stage(workers, next_queue, n_next_workers):
+        # Wait for all workers of a stage and then tell the next stage that no more papers are coming
+        await asyncio.gather(*workers)
+        for _ in range(n_next_workers):
+            await next_queue.put(None)
+
+    print("Downloading, converting and evaluating papers...")
+
+    # Each worker loads the Pix2Text model once and reuses it for all the PDFs it converts. The
+    # workers are started while download threads are running, so they are spawned, not forked
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=pdf_to_markdown.init_worker, initargs=(silent, conversion_mode)) as pool:
+        await asyncio.gather(
+            run_stage([download_worker() for _ in range(max_downloads)], papers_to_convert, processes),
+            run_stage([convert_worker(pool) for _ in range(processes)], papers_to_evaluate, max_concurrency),
+            *(evaluate_worker() for _ in range(max_concurrency)),
+        )
+
+    print(f"Out of a total of {len(papers)} papers, {len(papers_evaluated)} were downloaded, converted and evaluated.")
+
+    return papers_evaluated
@@ -17,6 +17,20 @@ Do not explain your answer.
 IMPORTANT: Return the score in JSON format.  Remember: The score MUST be an integer between 0 and 9.
 """
 
+SYSTEM_GENERATE_ABSTRACT_RELEVANCE_SCORE = """
+You are an expert academic assistant. You will be given a 'User prompt' followed by the 'Title and abstract' of a paper.
+
+Your task is to assign a **relevance score** to the paper with respect to the user's prompt, based only on its title and abstract.
+
+The output must be a **single digit from 0 to 9**, where:
+- 0 means "clearly not relevant at all"
+- 9 means "perfect match to the prompt"
+If the title and abstract are too short to judge, give a score in the middle of the range.
+
+Do not explain your answer.
+IMPORTANT: Return the score in JSON format.  Remember: The score MUST be an integer between 0 and 9.
+"""
+
 SYSTEM_GENERATE_QUALITY_SCORE = """
 You are an expert academic assistant. You will be given a 'Review' of a paper.
 Your task is to assign a quality score to the paper based solely on the content of the review.
@@ -122,3 +136,50 @@ Do not write anything other than this paragraph, do not include any additional t
 
 """
 
+
+SYSTEM_ANALYZE_PAPER = """
+You are an expert academic assistant. The user message starts with the full content of a research paper in markdown format, followed by a task.
+Carry out the task for the paper. Only output what the task asks for.
+"""
+
+def shared_prefix_prompt(paper_text, task):
+    # The paper comes first so that all the tasks for a paper share the same prefix,
+    # which lets the LLM server reuse its cache of the (long) paper between requests
+    return f"Paper content:\n{paper_text}\n\nTask:\n{task}"
+
+TASK_REVIEW_QUALITY = SYSTEM_GENERATE_REVIEW_QUALITY.replace(
+    "User gives is the paper you need to review:",
+    "Write a review of the paper above in this format.",
+)
+
+def task_generate_summary(prompt):
+
+    return f"""{SYSTEM_GENERATE_SUMMARY}
+    User prompt: {prompt}
+    """
+
+def task_analyze_paper(prompt):
+
+    return f"""
+    Analyze the paper above with respect to the research question of a user and return the result in JSON format with the following fields:
+    - relevance_review: A review of the paper focussing on the information in the paper that the research question concerns. If the paper is irrelevant, say so and summarize it shortly.
+    - relevance_score: A single digit from 0 ("not relevant at all") to 9 ("perfect match to the research question").
+    - quality_review: A review of the paper as for a top journal with open review, covering its summary, strengths and weaknesses, questions and limitations.
+    - quality_score: A single digit from 0 ("the paper is fatally flawed or entirely unworthy") to 9 ("the paper is of outstanding quality and should be accepted without reservation").
+    - summary: A concise summary of the main contributions and findings of the paper as they relate to the research question, without introductory phrases, headings or follow-up questions.
+
+    IMPORTANT: The scores MUST be integers between 0 and 9.
+
+    User question: {prompt}
+    """
+
+def system_combine_parts(result, instructions):
+
+    return f"""
+    You are an expert academic assistant. A long research paper was split into consecutive parts and a {result} was written for each part separately.
+    You are given these partial results in order. Combine them into a single {result} of the whole paper.
+    Merge overlapping points, keep the most important information from every part and do not mention that the paper was split into parts.
+
+    The partial results were written following these instructions, which also apply to the combined {result}:
+    {instructions}
+    """
@@ -0,0 +1,179 @@
+import time
+import random
+import collections
+import asyncio
+import logging
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+# HTTP status codes of responses that are worth retrying
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# HTTP status codes with which the server says it is overloaded
+OVERLOAD_STATUS_CODES = {429, 503}
+# Weight of the latest request in the moving average of the latency
+LATENCY_SMOOTHING = 0.3
+# The latency without load of a kind of request is estimated as a low percentile of its
+# requests in the last LATENCY_WINDOW_SECONDS, so that neither a few fast outliers nor
+# an overload that grows with the concurrency limit move it
+LATENCY_WINDOW_SECONDS = 600
+MAX_LATENCY_SAMPLES = 1000
+BASELINE_PERCENTILE = 0.1
+# Number of requests of a kind needed before its latency can reduce the concurrency limit
+MIN_LATENCY_SAMPLES = 10
+
+def is_transient(error):
+    """Whether a failed LLM request may succeed when retried, e.g. after a timeout or a 503 response."""
+    if isinstance(error, APIConnectionError):  # Includes timeouts
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in TRANSIENT_STATUS_CODES
+
+def is_overload(error):
+    """Whether a failed LLM request means that the server is overloaded, i.e. it timed out or was answered with 429 or 503."""
+    if isinstance(error, APITimeoutError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in OVERLOAD_STATUS_CODES
+
+class _Latency:
+    # Moving average of the latency of one kind of request, and its estimated latency
+    # without load from the latencies of its latest requests
+    def __init__(self):
+        self.average = None
+        self.window = collections.deque(maxlen=MAX_LATENCY_SAMPLES)
+
+    def add(self, latency):
+        now = time.monotonic()
+        self.window.append((now, latency))
+        while self.window[0][0] < now - LATENCY_WINDOW_SECONDS:
+            self.window.popleft()
+        if self.average is None:
+            self.average = latency
+        else:
+            self.average += LATENCY_SMOOTHING * (latency - self.average)
+
+    def baseline(self):
+        if len(self.window) < MIN_LATENCY_SAMPLES:
+            return None
+        return sorted(latency for _, latency in self.window)[int(BASELINE_PERCENTILE * len(self.window))]
+
+class RequestGovernor:
+    """
+    Limit the number of concurrent LLM requests adaptively and retry failed requests.
+
+    The concurrency limit follows AIMD (additive increase, multiplicative decrease):
+    each successful request raises it by 1/limit, i.e. by about one per round of
+    requests, until the server slows down. It is halved when a request times out or
+    the server answers 429 (rate limited) or 503 (overloaded), and reduced by a
+    quarter when requests get slower, i.e. when the average latency of a kind of
+    request exceeds `latency_tolerance` times its estimated latency without load (a
+    low percentile of the latencies of its recent requests), which means they are
+    queueing on the server. A decrease is caused only by requests started after the
+    previous decrease, so that one overload does not collapse the limit.
+
+    Requests failing with a transient error (a timeout, a connection error, 429 or a
+    5xx response) are retried up to `max_retries` times after a randomized exponential
+    backoff ("full jitter"), or after the delay asked for by a Retry-After header.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 latency_tolerance=2.0):
+        """
+        Args:
+            initial_limit (int): Number of concurrent requests allowed at the start.
+            min_limit (int): Minimal number of concurrent requests allowed.
+            max_limit (int): Maximal number of concurrent requests allowed.
+            max_retries (int): Maximal number of retries of a request.
+            base_delay (float): Maximal delay in seconds before the first retry, doubled for each further retry.
+            max_delay (float): Maximal delay in seconds before a retry.
+            latency_tolerance (float): Slowdown of the latency that is taken as the server being overloaded.
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self._latencies = {}
+        self._last_decrease = 0.0
+        self._waiters = []
+
+    async def run(self, request, kind="default"):
+        """
+        Run `request`, waiting for a free slot under the concurrency limit and
+        retrying it on transient errors.
+
+        Args:
+            request (coroutine function): Sends the request, called again for each retry.
+            kind (hashable): Kind of the request. Latencies are only compared between
+                requests of the same kind, e.g. of similar prompt and response lengths.
+
+        Returns:
+            The result of `request`.
+
+        Raises:
+            Exception: The error of the last attempt, if it was not transient or all retries failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            start = time.monotonic()
+            try:
+                result = await request()
+            except Exception as e:
+                if not is_transient(e) or attempt == self.max_retries:
+                    raise
+                if is_overload(e):
+                    self._decrease(start, 0.5, f"the request failed: {e}")
+                delay = self._retry_delay(attempt, e)
+                logging.warning(f"LLM request failed ({e}), retry {attempt + 1}/{self.max_retries} in {delay:.1f} s")
+            else:
+                self._on_success(kind, start, time.monotonic() - start)
+                return result
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, attempt, error):
+        retry_after = None
+        if isinstance(error, APIStatusError):
+            try:
+                retry_after = float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # The woken requests check again whether there is a free slot
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _on_success(self, kind, start, latency):
+        averages = self._latencies.setdefault(kind, _Latency())
+        averages.add(latency)
+        baseline = averages.baseline()
+        if baseline is not None and averages.average > self.latency_tolerance * baseline:
+            self._decrease(start, 0.75, f"requests slowed down to {averages.average:.1f} s from {baseline:.1f} s")
+        elif self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def _decrease(self, start, factor, reason):
+        if start < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.limit = max(self.min_limit, self.limit * factor)
+        logging.info(f"Reducing the LLM concurrency limit to {int(self.limit)}: {reason}")